@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+Offline Load Test
+Drives the bot's handlers with synthetic Telegram updates against the mock
+OpenAI server and reports throughput, latency percentiles and event-loop lag
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import itertools
+import subprocess
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class FakeTelegram:
+    """Counts Telegram API calls and simulates their round trip"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+        self.message_ids = itertools.count(1)
+
+    async def call(self):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.username = f"user{user_id}"
+        self.mention = f"[User {user_id}](tg://user?id={user_id})"
+
+class FakeChat:
+    def __init__(self, chat_id: int, chat_type):
+        self.id = chat_id
+        self.type = chat_type
+
+class FakeMessage:
+    """Subset of pyrogram's Message used by the handlers"""
+
+    def __init__(self, telegram: FakeTelegram, chat: FakeChat, user: FakeUser, text: str = ""):
+        self.telegram = telegram
+        self.id = next(telegram.message_ids)
+        self.chat = chat
+        self.from_user = user
+        self.text = text
+        self.replies = []
+
+    @property
+    def final_text(self) -> str:
+        """Text of the last reply, after all edits"""
+        return self.replies[-1].text if self.replies else ""
+
+    async def reply_text(self, text: str, **kwargs) -> "FakeMessage":
+        await self.telegram.call()
+        reply = FakeMessage(self.telegram, self.chat, self.from_user, text)
+        self.replies.append(reply)
+        return reply
+
+    async def reply_document(self, document, **kwargs) -> "FakeMessage":
+        return await self.reply_text(kwargs.get('caption') or "")
+
+    async def edit_text(self, text: str, **kwargs) -> "FakeMessage":
+        await self.telegram.call()
+        self.text = text
+        return self
+
+    async def delete(self):
+        await self.telegram.call()
+
+class FakeInlineQuery:
+    def __init__(self, telegram: FakeTelegram, user: FakeUser, query: str):
+        self.telegram = telegram
+        self.id = str(next(telegram.message_ids))
+        self.from_user = user
+        self.query = query
+        self.results = None
+
+    async def answer(self, results=None, **kwargs):
+        await self.telegram.call()
+        self.results = results
+
+class FakeCallbackQuery:
+    def __init__(self, telegram: FakeTelegram, message: FakeMessage, data: str):
+        self.telegram = telegram
+        self.message = message
+        self.from_user = message.from_user
+        self.data = data
+
+    async def answer(self, text: str = None, show_alert: bool = False, **kwargs):
+        await self.telegram.call()
+
+class FakeClient:
+    """Subset of pyrogram's Client used by the handlers"""
+
+    def __init__(self, telegram: FakeTelegram):
+        self.telegram = telegram
+        self.sent = 0
+
+    async def send_chat_action(self, chat_id, action):
+        await self.telegram.call()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self.telegram.call()
+        self.sent += 1
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        await self.telegram.call()
+
+    async def get_me(self):
+        await self.telegram.call()
+        return FakeUser(0)
+
+def percentile(values: list, pct: float) -> float:
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+async def monitor_loop_lag(samples: list, interval: float = 0.01):
+    """Measure how late the event loop wakes up a sleeping task"""
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        samples.append(time.monotonic() - started - interval)
+
+QUESTIONS = [
+    "What is the capital of France?",
+    "Explain quantum computing in simple terms",
+    "Write a haiku about the ocean",
+    "How do I reverse a list in Python?",
+    "What causes the seasons on Earth?",
+]
+
+class LoadTest:
+    """Runs virtual users against the real handlers"""
+
+    def __init__(self, bot, args):
+        self.bot = bot
+        self.args = args
+        self.telegram = FakeTelegram(args.telegram_latency)
+        self.client = FakeClient(self.telegram)
+        self.latencies = {}
+        self.failures = {}
+        self.groups = [-1000000000000 - i for i in range(args.groups)]
+        for group_id in self.groups:
+            bot.bot_data.authorize_group(group_id)
+
+        self.operations = []
+        for part in args.mix.split(','):
+            name, _, weight = part.partition('=')
+            self.operations += [name.strip()] * int(weight or 1)
+
+    def question(self, user_id: int) -> str:
+        text = random.choice(QUESTIONS)
+        # Unique suffixes keep caches from answering everything
+        if random.random() >= self.args.repeat_ratio:
+            text += f" (#{user_id}-{random.randrange(10 ** 6)})"
+        return text
+
+    async def ask(self, user: FakeUser) -> bool:
+        ChatType = self.bot.enums.ChatType
+        if self.groups and random.random() < 0.5:
+            chat = FakeChat(random.choice(self.groups), ChatType.SUPERGROUP)
+        else:
+            chat = FakeChat(user.id, ChatType.PRIVATE)
+        message = FakeMessage(self.telegram, chat, user, f"/ask {self.question(user.id)}")
+        await self.bot.ask_command(self.client, message)
+        return self.succeeded(message.final_text)
+
+    async def chat(self, user: FakeUser) -> bool:
+        chat = FakeChat(user.id, self.bot.enums.ChatType.PRIVATE)
+        message = FakeMessage(self.telegram, chat, user, self.question(user.id))
+        await self.bot.natural_conversation_handler(self.client, message)
+        return self.succeeded(message.final_text)
+
+    async def inline(self, user: FakeUser) -> bool:
+        query = FakeInlineQuery(self.telegram, user, self.question(user.id))
+        await self.bot.inline_query_handler(self.client, query)
+        return bool(query.results) and not query.results[0].title.startswith("❌")
+
+    async def callback(self, user: FakeUser) -> bool:
+        chat = FakeChat(user.id, self.bot.enums.ChatType.PRIVATE)
+        message = FakeMessage(self.telegram, chat, user)
+        await self.bot.callback_query_handler(
+            self.client, FakeCallbackQuery(self.telegram, message, random.choice(["stats", "help", "change_model"]))
+        )
+        return True
+
+    @staticmethod
+    def succeeded(text: str) -> bool:
+        return bool(text) and not text.startswith(("❌", "⏳", "🚦", "⌛", "🔌"))
+
+    async def virtual_user(self, index: int):
+        user = FakeUser(100000 + index)
+        # Spread start times so users do not arrive in lockstep
+        await asyncio.sleep(random.uniform(0, self.args.ramp_up))
+        for _ in range(self.args.requests):
+            operation = random.choice(self.operations)
+            started = time.monotonic()
+            try:
+                ok = await getattr(self, operation)(user)
+            except Exception as e:
+                print(f"  {operation} raised {type(e).__name__}: {e}")
+                ok = False
+            self.latencies.setdefault(operation, []).append(time.monotonic() - started)
+            if not ok:
+                self.failures[operation] = self.failures.get(operation, 0) + 1
+            if self.args.think_time:
+                await asyncio.sleep(random.expovariate(1 / self.args.think_time))
+
+    async def run(self):
+        lag_samples = []
+        monitor = asyncio.create_task(monitor_loop_lag(lag_samples))
+        started = time.monotonic()
+        await asyncio.gather(*(self.virtual_user(i) for i in range(self.args.users)))
+        elapsed = time.monotonic() - started
+        monitor.cancel()
+        self.report(elapsed, lag_samples)
+
+    def report(self, elapsed: float, lag_samples: list):
+        total = sum(len(values) for values in self.latencies.values())
+        print("\n" + "=" * 72)
+        print(f"  Users: {self.args.users}   Operations: {total}   Wall time: {elapsed:.2f}s")
+        print(f"  Throughput: {total / elapsed:.1f} ops/s   Telegram calls: {self.telegram.calls}")
+        print("=" * 72)
+        print(f"  {'operation':<10} {'count':>7} {'failed':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+        for operation, values in sorted(self.latencies.items()):
+            print(
+                f"  {operation:<10} {len(values):>7} {self.failures.get(operation, 0):>7} "
+                f"{percentile(values, 50):>7.3f}s {percentile(values, 95):>7.3f}s "
+                f"{percentile(values, 99):>7.3f}s {max(values):>7.3f}s"
+            )
+        print("-" * 72)
+        print(
+            f"  Event-loop lag: p50 {percentile(lag_samples, 50) * 1000:.1f}ms  "
+            f"p99 {percentile(lag_samples, 99) * 1000:.1f}ms  "
+            f"max {max(lag_samples, default=0) * 1000:.1f}ms"
+        )
+        print("=" * 72)
+
+def start_mock_server(args) -> subprocess.Popen:
+    """Run mock_openai_server.py in its own process"""
+    process = subprocess.Popen(
+        [
+            sys.executable, os.path.join(BOT_DIR, 'mock_openai_server.py'),
+            '--port', str(args.mock_port),
+            '--latency', str(args.openai_latency),
+            '--tokens-per-second', str(args.tokens_per_second),
+            '--completion-tokens', str(args.completion_tokens),
+            '--error-rate', str(args.error_rate),
+        ],
+        stdout=subprocess.PIPE
+    )
+    # Wait for the "listening" line
+    process.stdout.readline()
+    return process
+
+def configure_environment(args, workdir: str):
+    """Point the bot at the mock server and a scratch data directory"""
+    os.environ['OPENAI_BASE_URL'] = args.openai_url or f"http://127.0.0.1:{args.mock_port}/v1"
+    os.environ['OPENAI_API_KEY'] = 'sk-loadtest'
+    os.environ['API_ID'] = '1'
+    os.environ['API_HASH'] = 'loadtest'
+    os.environ['BOT_TOKEN'] = '1:loadtest'
+    os.environ['DATA_DIR'] = workdir
+    # Synthetic users would otherwise be throttled by admission control
+    os.environ.setdefault('RATE_LIMIT_USER_PER_MIN', '100000')
+    os.environ.setdefault('RATE_LIMIT_USER_BURST', '100000')
+    os.environ.setdefault('RATE_LIMIT_GROUP_PER_MIN', '100000')
+    os.environ.setdefault('RATE_LIMIT_GROUP_BURST', '100000')
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for the Telegram AI bot")
+    parser.add_argument('--users', type=int, default=100, help="concurrent virtual users")
+    parser.add_argument('--requests', type=int, default=10, help="operations per user")
+    parser.add_argument('--mix', default="ask=5,chat=3,inline=1,callback=1",
+                        help="operation weights (ask, chat, inline, callback)")
+    parser.add_argument('--groups', type=int, default=5, help="authorized groups /ask is sent from")
+    parser.add_argument('--repeat-ratio', type=float, default=0.2, help="share of repeated questions")
+    parser.add_argument('--think-time', type=float, default=0.5, help="mean seconds between a user's operations")
+    parser.add_argument('--ramp-up', type=float, default=2.0, help="seconds over which users start")
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help="simulated Telegram API round trip")
+    parser.add_argument('--openai-url', help="use a running mock server instead of starting one")
+    parser.add_argument('--mock-port', type=int, default=8089)
+    parser.add_argument('--openai-latency', type=float, default=0.5, help="mock seconds to first token")
+    parser.add_argument('--tokens-per-second', type=float, default=50)
+    parser.add_argument('--completion-tokens', type=int, default=100)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    mock = None if args.openai_url else start_mock_server(args)
+    workdir = tempfile.mkdtemp(prefix='bot-loadtest-')
+    try:
+        configure_environment(args, workdir)
+        # The bot writes bot.log relative to the working directory
+        os.chdir(workdir)
+        sys.path.insert(0, BOT_DIR)
+        import telegram_ai_bot as bot
+        bot.load_state()
+
+        async def run():
+            try:
+                await LoadTest(bot, args).run()
+            finally:
+                bot.bot_data.close()
+                if bot.openai_http_client:
+                    await bot.openai_http_client.aclose()
+
+        asyncio.run(run())
+    finally:
+        if mock:
+            mock.terminate()
+    return 0
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        print("\n\nLoad test cancelled.")
+        sys.exit(1)
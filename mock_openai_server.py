@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+Mock OpenAI API Server
+Local stand-in for the OpenAI chat completions, files and batches APIs used
+for load testing
+"""
+
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+
+WORD = "lorem "
+
+def parse_multipart(content_type: str, data: bytes) -> dict:
+    """Fields of a multipart/form-data body, by name"""
+    boundary = content_type.split('boundary=', 1)[1].strip('"').encode()
+    fields = {}
+    for part in data.split(b'--' + boundary)[1:]:
+        if part.startswith(b'--'):
+            break
+        head, _, value = part.partition(b'\r\n\r\n')
+        name = re.search(rb'name="([^"]*)"', head)
+        if name:
+            fields[name.group(1).decode()] = value[:-2] if value.endswith(b'\r\n') else value
+    return fields
+
+class MockOpenAIServer:
+    """Answers chat completion requests with synthetic text"""
+
+    def __init__(self, latency: float = 0.5, tokens_per_second: float = 50,
+                 completion_tokens: int = 100, error_rate: float = 0.0, batch_delay: float = 5.0):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.batch_delay = batch_delay
+        self.ids = itertools.count(1)
+        self.requests = 0
+        # Uploaded and generated files: id -> (file object, content)
+        self.files = {}
+        self.batches = {}
+        self.batch_tasks = set()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve requests on a keep-alive connection"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                data = await reader.readexactly(length) if length else b''
+                content_type = headers.get('content-type', '')
+                if content_type.startswith('multipart/form-data'):
+                    body = parse_multipart(content_type, data)
+                else:
+                    body = json.loads(data) if data else {}
+
+                await self.route(method, path.split('?')[0], body, writer)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method: str, path: str, body: dict, writer: asyncio.StreamWriter):
+        """Dispatch a request to its endpoint"""
+        self.requests += 1
+        if method == 'GET' and path == '/v1/models':
+            self.send_json(writer, 200, {
+                'object': 'list',
+                'data': [{'id': 'gpt-4o-mini', 'object': 'model', 'created': 0, 'owned_by': 'mock'}]
+            })
+        elif method == 'POST' and path == '/v1/chat/completions':
+            await self.chat_completion(body, writer)
+        elif method == 'POST' and path == '/v1/files':
+            self.upload_file(body, writer)
+        elif method == 'GET' and re.fullmatch(r'/v1/files/[^/]+/content', path):
+            self.file_content(path.split('/')[3], writer)
+        elif method == 'POST' and path == '/v1/batches':
+            self.create_batch(body, writer)
+        elif method == 'GET' and re.fullmatch(r'/v1/batches/[^/]+', path):
+            self.retrieve_batch(path.split('/')[3], writer)
+        else:
+            self.send_json(writer, 404, {'error': {'message': f'Unknown endpoint {path}', 'type': 'invalid_request_error'}})
+        await writer.drain()
+
+    def send_json(self, writer: asyncio.StreamWriter, status: int, payload: dict, extra_headers: str = ''):
+        """Write a JSON response"""
+        self.send_bytes(writer, status, json.dumps(payload).encode(), 'application/json', extra_headers)
+    
+    def send_bytes(self, writer: asyncio.StreamWriter, status: int, data: bytes,
+                   content_type: str, extra_headers: str = ''):
+        """Write a response with a raw body"""
+        writer.write(
+            f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+            f"Content-Type: {content_type}\r\nContent-Length: {len(data)}\r\n"
+            f"{extra_headers}\r\n".encode() + data
+        )
+    
+    def not_found(self, writer: asyncio.StreamWriter, what: str):
+        self.send_json(writer, 404, {'error': {'message': f'No such {what}', 'type': 'invalid_request_error'}})
+
+    def usage(self, body: dict, completion_tokens: int) -> dict:
+        """Token usage for a request"""
+        prompt_tokens = sum(len(str(m.get('content', ''))) for m in body.get('messages', [])) // 4 + 1
+        return {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens
+        }
+
+    def completion(self, body: dict) -> dict:
+        """A non-streamed chat completion for a request body"""
+        completion_tokens = min(self.completion_tokens, body.get('max_tokens') or self.completion_tokens)
+        return {
+            'id': f"chatcmpl-mock-{next(self.ids)}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'gpt-4o-mini'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': WORD * completion_tokens},
+                'finish_reason': 'stop',
+                'logprobs': None
+            }],
+            'usage': self.usage(body, completion_tokens)
+        }
+    
+    async def chat_completion(self, body: dict, writer: asyncio.StreamWriter):
+        """Answer /v1/chat/completions, streamed or not"""
+        if self.error_rate and random.random() < self.error_rate:
+            await asyncio.sleep(self.latency / 2)
+            if random.random() < 0.5:
+                self.send_json(writer, 429, {'error': {'message': 'Rate limit reached', 'type': 'requests'}},
+                               "Retry-After: 1\r\n")
+            else:
+                self.send_json(writer, 500, {'error': {'message': 'Mock server error', 'type': 'server_error'}})
+            return
+
+        model = body.get('model', 'gpt-4o-mini')
+        completion_tokens = min(self.completion_tokens, body.get('max_tokens') or self.completion_tokens)
+        completion_id = f"chatcmpl-mock-{next(self.ids)}"
+        created = int(time.time())
+
+        await asyncio.sleep(self.latency)
+
+        if not body.get('stream'):
+            await asyncio.sleep(completion_tokens / self.tokens_per_second)
+            self.send_json(writer, 200, self.completion(body))
+            return
+
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+            b"Transfer-Encoding: chunked\r\n\r\n"
+        )
+
+        def event(payload) -> bytes:
+            data = f"data: {payload if isinstance(payload, str) else json.dumps(payload)}\n\n".encode()
+            return f"{len(data):x}\r\n".encode() + data + b"\r\n"
+
+        def chunk(delta: dict, finish_reason=None) -> dict:
+            return {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': created,
+                'model': model,
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason, 'logprobs': None}]
+            }
+
+        writer.write(event(chunk({'role': 'assistant', 'content': ''})))
+        for _ in range(completion_tokens):
+            await asyncio.sleep(1 / self.tokens_per_second)
+            writer.write(event(chunk({'content': WORD})))
+            await writer.drain()
+        writer.write(event(chunk({}, 'stop')))
+
+        if (body.get('stream_options') or {}).get('include_usage'):
+            writer.write(event({
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': created,
+                'model': model,
+                'choices': [],
+                'usage': self.usage(body, completion_tokens)
+            }))
+        writer.write(event('[DONE]'))
+        writer.write(b"0\r\n\r\n")
+
+    def store_file(self, filename: str, content: bytes, purpose: str) -> dict:
+        """Keep a file and return its file object"""
+        file = {
+            'id': f"file-mock-{next(self.ids)}",
+            'object': 'file',
+            'bytes': len(content),
+            'created_at': int(time.time()),
+            'filename': filename,
+            'purpose': purpose,
+            'status': 'processed'
+        }
+        self.files[file['id']] = (file, content)
+        return file
+    
+    def upload_file(self, body: dict, writer: asyncio.StreamWriter):
+        """Answer POST /v1/files (multipart upload)"""
+        if 'file' not in body:
+            self.send_json(writer, 400, {'error': {'message': 'Missing file', 'type': 'invalid_request_error'}})
+            return
+        purpose = body.get('purpose', b'batch').decode()
+        self.send_json(writer, 200, self.store_file('upload.jsonl', body['file'], purpose))
+    
+    def file_content(self, file_id: str, writer: asyncio.StreamWriter):
+        """Answer GET /v1/files/{id}/content"""
+        if file_id not in self.files:
+            self.not_found(writer, f"file {file_id}")
+            return
+        self.send_bytes(writer, 200, self.files[file_id][1], 'application/octet-stream')
+    
+    def create_batch(self, body: dict, writer: asyncio.StreamWriter):
+        """Answer POST /v1/batches; the job completes after batch_delay seconds"""
+        input_file_id = body.get('input_file_id')
+        if input_file_id not in self.files:
+            self.not_found(writer, f"file {input_file_id}")
+            return
+        created = int(time.time())
+        batch = {
+            'id': f"batch_mock_{next(self.ids)}",
+            'object': 'batch',
+            'endpoint': body.get('endpoint'),
+            'errors': None,
+            'input_file_id': input_file_id,
+            'completion_window': body.get('completion_window', '24h'),
+            'status': 'validating',
+            'output_file_id': None,
+            'error_file_id': None,
+            'created_at': created,
+            'in_progress_at': None,
+            'expires_at': created + 86400,
+            'completed_at': None,
+            'request_counts': {'total': 0, 'completed': 0, 'failed': 0},
+            'metadata': body.get('metadata')
+        }
+        self.batches[batch['id']] = batch
+        task = asyncio.create_task(self.run_batch(batch))
+        self.batch_tasks.add(task)
+        task.add_done_callback(self.batch_tasks.discard)
+        self.send_json(writer, 200, batch)
+    
+    def retrieve_batch(self, batch_id: str, writer: asyncio.StreamWriter):
+        """Answer GET /v1/batches/{id}"""
+        if batch_id not in self.batches:
+            self.not_found(writer, f"batch {batch_id}")
+            return
+        self.send_json(writer, 200, self.batches[batch_id])
+    
+    async def run_batch(self, batch: dict):
+        """Answer every request of a batch and write its output and error files"""
+        lines = [line for line in self.files[batch['input_file_id']][1].decode().splitlines() if line.strip()]
+        batch['status'] = 'in_progress'
+        batch['in_progress_at'] = int(time.time())
+        batch['request_counts']['total'] = len(lines)
+        await asyncio.sleep(self.batch_delay)
+
+        output, errors = [], []
+        for line in lines:
+            request = json.loads(line)
+            result = {'id': f"batch_req_mock_{next(self.ids)}", 'custom_id': request['custom_id'], 'error': None}
+            if self.error_rate and random.random() < self.error_rate:
+                result['response'] = {
+                    'status_code': 500,
+                    'request_id': f"req_mock_{next(self.ids)}",
+                    'body': {'error': {'message': 'Mock server error', 'type': 'server_error'}}
+                }
+                errors.append(result)
+            else:
+                result['response'] = {
+                    'status_code': 200,
+                    'request_id': f"req_mock_{next(self.ids)}",
+                    'body': self.completion(request.get('body', {}))
+                }
+                output.append(result)
+
+        def jsonl(results: list) -> bytes:
+            return ''.join(json.dumps(result) + '\n' for result in results).encode()
+
+        if output:
+            batch['output_file_id'] = self.store_file('batch_output.jsonl', jsonl(output), 'batch_output')['id']
+        if errors:
+            batch['error_file_id'] = self.store_file('batch_errors.jsonl', jsonl(errors), 'batch_output')['id']
+        batch['request_counts'].update(completed=len(output), failed=len(errors))
+        batch['status'] = 'completed'
+        batch['completed_at'] = int(time.time())
+
+async def serve(server: MockOpenAIServer, host: str, port: int):
+    """Run the mock server until cancelled"""
+    listener = await asyncio.start_server(server.handle, host, port)
+    print(f"Mock OpenAI API listening on http://{host}:{port}/v1", flush=True)
+    async with listener:
+        await listener.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI API server for load testing")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.5, help="seconds before the first token")
+    parser.add_argument('--tokens-per-second', type=float, default=50)
+    parser.add_argument('--completion-tokens', type=int, default=100, help="tokens per answer")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests failing with 429/500")
+    parser.add_argument('--batch-delay', type=float, default=5.0, help="seconds before a batch job completes")
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(args.latency, args.tokens_per_second, args.completion_tokens,
+                              args.error_rate, args.batch_delay)
+    asyncio.run(serve(server, args.host, args.port))
+    return 0
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -4,32 +4,174 @@ Advanced Telegram AI Bot with OpenAI Integration
 Features: Inline Mode, User Auth, Group Auth, Model Selection, Owner Controls
 """
 
+import io
 import os
 import json
+import time
+import zlib
+import math
+import sqlite3
+import heapq
+import random
+import socket
+import hashlib
+import functools
+import itertools
+import queue
+import threading
+import atexit
+import asyncio
 import logging
+import logging.handlers
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime
-from typing import Dict, List, Optional
-from pyrogram import Client, filters, enums
+from typing import Dict, List, NamedTuple, Optional
+from pyrogram import Client, filters, enums, idle
+from pyrogram.errors import FloodWait, MessageNotModified
+from pyrogram.handlers import CallbackQueryHandler, InlineQueryHandler, MessageHandler
 from pyrogram.types import (
     Message, InlineQuery, InlineQueryResultArticle,
     InputTextMessageContent, InlineKeyboardMarkup, InlineKeyboardButton,
     CallbackQuery
 )
-from openai import OpenAI
+import httpx
+import openai
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
 
+try:
+    import tiktoken
+except ImportError:
+    # Token counts fall back to estimate_tokens
+    tiktoken = None
+
+try:
+    import redis
+    import redis.asyncio
+except ImportError:
+    # Only needed for STORAGE_BACKEND=redis
+    redis = None
+
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log'),
-        logging.StreamHandler()
-    ]
-)
+# Logging configuration
+LOG_FILE = os.getenv('LOG_FILE', 'bot.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# "text" or "json" (one object per line, including structured fields)
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+# Rotate by size, or by time when LOG_ROTATE_WHEN is set (e.g. "midnight")
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN', '')
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))
+# Warnings and errors from one line of code are capped at LOG_SAMPLE_BURST
+# per LOG_SAMPLE_INTERVAL seconds (0 = no cap)
+LOG_SAMPLE_BURST = int(os.getenv('LOG_SAMPLE_BURST', 10))
+LOG_SAMPLE_INTERVAL = float(os.getenv('LOG_SAMPLE_INTERVAL', 60))
+
+# Attributes every LogRecord has; anything else was passed in extra=
+STANDARD_LOG_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as JSON objects, including fields passed in extra="""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_LOG_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class SamplingFilter(logging.Filter):
+    """Rate-limits warnings and errors per call site
+    
+    The first LOG_SAMPLE_BURST records from a line of code in each
+    LOG_SAMPLE_INTERVAL window pass; the rest are dropped and counted, and
+    the count is reported on the first record of the next window.
+    """
+    
+    def __init__(self, burst: int = LOG_SAMPLE_BURST, interval: float = LOG_SAMPLE_INTERVAL):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        # (pathname, lineno) -> [window start, records passed, records dropped]
+        self.sites = {}
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING or not self.burst:
+            return True
+        now = time.monotonic()
+        site = self.sites.get((record.pathname, record.lineno))
+        if site is None or now - site[0] >= self.interval:
+            dropped = site[2] if site else 0
+            self.sites[(record.pathname, record.lineno)] = [now, 1, 0]
+            if dropped:
+                record.msg = f"{record.msg} ({dropped} similar messages suppressed)"
+                record.suppressed = dropped
+            return True
+        if site[1] < self.burst:
+            site[1] += 1
+            return True
+        site[2] += 1
+        return False
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    """Queues records as they are for a listener in the same process
+    
+    The stock prepare() formats the message and traceback on the caller's
+    thread and drops exc_info; here the listener's formatters do all of it.
+    """
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Route all logging through a queue to a background writer thread
+    
+    Callers only enqueue records, so a burst of log lines never blocks the
+    event loop on disk or console writes.
+    """
+    if LOG_ROTATE_WHEN:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT
+        )
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT
+        )
+    if LOG_FORMAT == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handlers = [file_handler, logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    queue_handler = LocalQueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(SamplingFilter())
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.handlers[:] = [queue_handler]
+    
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Write out whatever is still queued at exit
+    atexit.register(listener.stop)
+    return listener
+
+# Logging is configured by main(); see setup_logging
 logger = logging.getLogger(__name__)
 
 # Configuration
@@ -39,37 +181,861 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 OWNER_ID = int(os.getenv('OWNER_ID', 0))
 
-# Initialize OpenAI client
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+def env_flag(name: str, default: bool = False) -> bool:
+    """Read a boolean flag from the environment"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+# Concurrency configuration
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', 64))
+# Seconds handed-off requests get to finish on shutdown
+SHUTDOWN_GRACE = float(os.getenv('SHUTDOWN_GRACE', 30))
+# Each process needs its own session file when several run side by side
+BOT_SESSION_NAME = os.getenv('BOT_SESSION_NAME', 'ai_assistant_bot')
+# Processes for token counting (0 = count on the event loop), and the input
+# size in characters below which shipping work to a process is not worth it
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', 0))
+OFFLOAD_MIN_CHARS = int(os.getenv('OFFLOAD_MIN_CHARS', 20000))
+OPENAI_MAX_CONCURRENCY = int(os.getenv('OPENAI_MAX_CONCURRENCY', 50))
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', 100))
+OPENAI_MAX_KEEPALIVE = int(os.getenv('OPENAI_MAX_KEEPALIVE', 20))
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', 120))
+OPENAI_CLIENT_CACHE_SIZE = int(os.getenv('OPENAI_CLIENT_CACHE_SIZE', 256))
+OPENAI_CLIENT_IDLE_TTL = float(os.getenv('OPENAI_CLIENT_IDLE_TTL', 1800))
+
+# Streaming configuration
+STREAM_RESPONSES = env_flag('STREAM_RESPONSES', True)
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1.5))
+STREAM_EDIT_INTERVAL_GROUP = float(os.getenv('STREAM_EDIT_INTERVAL_GROUP', 3.0))
+STREAM_EDIT_MIN_CHARS = int(os.getenv('STREAM_EDIT_MIN_CHARS', 80))
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Answers needing more messages than this are sent as a file (0 = never)
+LONG_RESPONSE_MAX_MESSAGES = int(os.getenv('LONG_RESPONSE_MAX_MESSAGES', 4))
+
+# Inline mode configuration
+INLINE_DEBOUNCE = float(os.getenv('INLINE_DEBOUNCE', 0.8))
+INLINE_CACHE_SIZE = int(os.getenv('INLINE_CACHE_SIZE', 1000))
+INLINE_CACHE_TTL = float(os.getenv('INLINE_CACHE_TTL', 600))
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', 30))
+
+# Response cache configuration
+RESPONSE_CACHE = env_flag('RESPONSE_CACHE', False)
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 5000))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 3600))
+# Cosine similarity needed for a near-duplicate hit; 0 disables the similarity tier
+RESPONSE_CACHE_SIMILARITY = float(os.getenv('RESPONSE_CACHE_SIMILARITY', 0))
+
+# Broadcast configuration
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 10))
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 25))
+BROADCAST_MAX_RETRIES = int(os.getenv('BROADCAST_MAX_RETRIES', 3))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', 5))
+# Lease keeping other workers from delivering the same broadcast
+BROADCAST_LEASE_TTL = BROADCAST_PROGRESS_INTERVAL * 3
+
+# Batch API (/batch): deferred answers at half the price
+BATCH_COLLECT_SECONDS = float(os.getenv('BATCH_COLLECT_SECONDS', 60))
+BATCH_MAX_REQUESTS = int(os.getenv('BATCH_MAX_REQUESTS', 1000))
+BATCH_POLL_INTERVAL = float(os.getenv('BATCH_POLL_INTERVAL', 30))
+BATCH_MAX_PENDING_PER_USER = int(os.getenv('BATCH_MAX_PENDING_PER_USER', 10))
+BATCH_ENDPOINT = '/v1/chat/completions'
+BATCH_DISCOUNT = 0.5
+BATCH_FINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+# Jobs that cannot be polled for this long are given up on
+BATCH_ABANDON_AFTER = 2 * 86400
+BATCH_LEASE_TTL = BATCH_POLL_INTERVAL * 3
+
+# Admission control configuration
+RATE_LIMIT_USER_PER_MIN = float(os.getenv('RATE_LIMIT_USER_PER_MIN', 10))
+RATE_LIMIT_USER_BURST = float(os.getenv('RATE_LIMIT_USER_BURST', 5))
+RATE_LIMIT_GROUP_PER_MIN = float(os.getenv('RATE_LIMIT_GROUP_PER_MIN', 30))
+RATE_LIMIT_GROUP_BURST = float(os.getenv('RATE_LIMIT_GROUP_BURST', 10))
+MODEL_MAX_CONCURRENCY = int(os.getenv('MODEL_MAX_CONCURRENCY', 20))
+
+# Retry and circuit breaker configuration
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', 3))
+OPENAI_RETRY_BASE_DELAY = float(os.getenv('OPENAI_RETRY_BASE_DELAY', 1.0))
+OPENAI_RETRY_MAX_DELAY = float(os.getenv('OPENAI_RETRY_MAX_DELAY', 30))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', 30))
+MODEL_FALLBACK = env_flag('MODEL_FALLBACK', False)
+
+# Latency-based routing configuration
+ROUTING_ENABLED = env_flag('ROUTING_ENABLED', False)
+ROUTING_WINDOW = float(os.getenv('ROUTING_WINDOW', 300))
+ROUTING_MIN_SAMPLES = int(os.getenv('ROUTING_MIN_SAMPLES', 20))
+ROUTING_P95_LATENCY = float(os.getenv('ROUTING_P95_LATENCY', 30))
+ROUTING_ERROR_RATE = float(os.getenv('ROUTING_ERROR_RATE', 0.2))
+
+# Scheduling configuration
+# Telegram stops accepting answers to an inline query after about 10 seconds
+INLINE_DEADLINE = float(os.getenv('INLINE_DEADLINE', 8))
+REQUEST_DEADLINE = float(os.getenv('REQUEST_DEADLINE', 300))
+# Let identical requests in flight at the same time share one completion
+COALESCE_REQUESTS = env_flag('COALESCE_REQUESTS', True)
+
+# Request priority classes, lower is served first
+PRIORITY_OWNER = 0
+PRIORITY_INLINE = 1
+PRIORITY_NORMAL = 2
+
+# Shared HTTP transport with a bounded connection pool
+# Created on first use by init_openai
+openai_http_client: Optional[httpx.AsyncClient] = None
+openai_client: Optional[AsyncOpenAI] = None
+
+def init_openai():
+    """Create the shared HTTP connection pool and the default OpenAI client"""
+    global openai_http_client, openai_client
+    if openai_client is not None:
+        return
+    openai_http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE
+        ),
+        timeout=OPENAI_TIMEOUT
+    )
+    # Retries are handled by call_openai_api, so the SDK's own are disabled
+    openai_client = AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        http_client=openai_http_client,
+        timeout=OPENAI_TIMEOUT,
+        max_retries=0
+    )
+
+# Metrics configuration (METRICS_PORT=0 disables the HTTP endpoint)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+# Seconds between OpenAI reachability probes for /readyz, and their timeout
+HEALTH_PROBE_INTERVAL = float(os.getenv('HEALTH_PROBE_INTERVAL', 60))
+HEALTH_PROBE_TIMEOUT = float(os.getenv('HEALTH_PROBE_TIMEOUT', 10))
+
+def _format_labels(names: tuple, values: tuple, extra: Optional[tuple] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{name}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+class Metric:
+    """Base class of Prometheus-style metrics"""
+    
+    kind = 'untyped'
+    
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        metrics_registry.append(self)
+    
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, '') for name in self.labels)
+    
+    def samples(self) -> List[str]:
+        return []
+    
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        return '\n'.join(lines + self.samples())
+
+class Counter(Metric):
+    """Monotonically increasing value"""
+    
+    kind = 'counter'
+    
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        super().__init__(name, help_text, labels)
+        self.values: Dict[tuple, float] = {}
+    
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+    
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in self.values.items()]
+
+class Gauge(Metric):
+    """Value read from a callback when metrics are rendered"""
+    
+    kind = 'gauge'
+    
+    def __init__(self, name: str, help_text: str, callback):
+        super().__init__(name, help_text)
+        self.callback = callback
+    
+    def samples(self) -> List[str]:
+        return [f"{self.name} {self.callback()}"]
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets"""
+    
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+    
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+        self.series: Dict[tuple, list] = {}
+    
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self.series.get(key)
+        if series is None:
+            # Per-bucket counts, then sum and count
+            series = self.series[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+    
+    def samples(self) -> List[str]:
+        lines = []
+        for key, series in self.series.items():
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, ('le', bound))} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, ('le', '+Inf'))} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {series[-1]}")
+        return lines
+
+metrics_registry: List[Metric] = []
+
+def render_metrics() -> str:
+    """Render all metrics in the Prometheus text format"""
+    return '\n'.join(metric.render() for metric in metrics_registry) + '\n'
+
+HANDLER_LATENCY = Histogram('bot_handler_latency_seconds', 'Time spent handling an update', ('handler',))
+OPENAI_LATENCY = Histogram('bot_openai_request_seconds', 'OpenAI request latency', ('model', 'outcome'))
+OPENAI_TTFT = Histogram('bot_openai_time_to_first_token_seconds', 'Time to the first streamed token', ('model',))
+OPENAI_TOKENS = Counter('bot_openai_tokens_total', 'Tokens billed by OpenAI', ('model',))
+OPENAI_COST = Counter('bot_openai_estimated_cost_usd_total', 'Estimated OpenAI spend in USD', ('model',))
+STORAGE_LATENCY = Histogram('bot_storage_write_seconds', 'Time spent writing bot data', ('operation',))
+
+def instrumented(handler):
+    """Record the latency of an update handler"""
+    name = handler.__name__
+    
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.monotonic()
+        try:
+            return await handler(*args, **kwargs)
+        finally:
+            HANDLER_LATENCY.observe(time.monotonic() - started, handler=name)
+    return wrapper
 
 # Data storage
-DATA_FILE = 'bot_data.json'
+DATA_DIR = os.getenv('DATA_DIR', '.')
+DATA_FILE = os.path.join(DATA_DIR, 'bot_data.json')
+DB_FILE = os.path.join(DATA_DIR, 'bot_data.db')
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json').lower()
+STORAGE_COMPACT_EVERY = int(os.getenv('STORAGE_COMPACT_EVERY', 1000))
+USAGE_FLUSH_BATCH = int(os.getenv('USAGE_FLUSH_BATCH', 100))
+USAGE_FLUSH_INTERVAL = float(os.getenv('USAGE_FLUSH_INTERVAL', 30))
+
+# Shared state (STORAGE_BACKEND=redis)
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+REDIS_PREFIX = os.getenv('REDIS_PREFIX', 'aibot')
+UPDATE_CLAIM_TTL = int(os.getenv('UPDATE_CLAIM_TTL', 600))
+# Identifies this process among the workers sharing state
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Token budgeting
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv('TOKEN_COUNT_CACHE_SIZE', 2048))
+# Seconds between attempts to load tokenizers that failed to download
+TOKENIZER_RETRY_INTERVAL = 60
+# Smallest answer worth requesting; longer prompts are rejected up front
+MIN_COMPLETION_TOKENS = int(os.getenv('MIN_COMPLETION_TOKENS', 256))
+# Tokens a user may spend per UTC day on the bot's API key (0 = unlimited)
+USER_DAILY_TOKEN_QUOTA = int(os.getenv('USER_DAILY_TOKEN_QUOTA', 0))
+
+# Conversation memory
+CONVERSATION_MAX_CHATS = int(os.getenv('CONVERSATION_MAX_CHATS', 1000))
+CONVERSATION_MAX_MESSAGES = int(os.getenv('CONVERSATION_MAX_MESSAGES', 40))
+CONVERSATION_IDLE_TTL = float(os.getenv('CONVERSATION_IDLE_TTL', 3600))
+CONVERSATION_HISTORY_TOKENS = int(os.getenv('CONVERSATION_HISTORY_TOKENS', 4000))
+CONVERSATION_PERSIST = env_flag('CONVERSATION_PERSIST', False)
+
+# Sections holding sets of ids; all other sections are dicts keyed by id
+LIST_SECTIONS = ('authorized_users', 'authorized_groups', 'banned_users')
+
+def utc_day() -> str:
+    """Current UTC date, which daily quotas are counted against"""
+    return time.strftime('%Y-%m-%d', time.gmtime())
+
+def default_data() -> dict:
+    """Return an empty data set"""
+    return {
+        'authorized_users': set(),
+        'authorized_groups': set(),
+        'user_preferences': {},
+        'usage_stats': {},
+        'banned_users': set(),
+        'user_api_keys': {}
+    }
+
+def apply_mutation(data: dict, op: str, section: str, key, value=None):
+    """Apply a single put/delete mutation to a data set"""
+    if section in LIST_SECTIONS:
+        members = data.setdefault(section, set())
+        if op == 'put':
+            members.add(key)
+        else:
+            members.discard(key)
+    else:
+        entries = data.setdefault(section, {})
+        if op == 'put':
+            entries[key] = value
+        else:
+            entries.pop(key, None)
+
+def iter_entries(data: dict):
+    """Yield (section, key, value) for every stored entry"""
+    for section, content in data.items():
+        if section in LIST_SECTIONS:
+            for key in content:
+                yield section, key, None
+        else:
+            for key, value in content.items():
+                yield section, key, value
+
+def _json_default(value):
+    """Serialize id sets as sorted JSON lists"""
+    if isinstance(value, set):
+        return sorted(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def read_snapshot(path: str) -> dict:
+    """Read a JSON snapshot, filling in missing sections"""
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        data = {}
+    for section, empty in default_data().items():
+        data.setdefault(section, empty)
+    for section in LIST_SECTIONS:
+        data[section] = set(data[section])
+    return data
+
+def replay_journal(data: dict, path: str) -> bool:
+    """Apply a journal's mutations to a data set; False if there is none"""
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn write from a crash; nothing after it is valid
+                    logger.warning("Ignoring truncated storage journal entry")
+                    break
+                apply_mutation(data, entry['op'], entry['section'], entry['key'], entry.get('value'))
+    except FileNotFoundError:
+        return False
+    return True
+
+def write_snapshot(data: dict, path: str):
+    """Write a snapshot to a temp file and atomically rename it over path"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2, default=_json_default)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class JsonStorage:
+    """JSON snapshot plus an append-only journal of mutations
+    
+    Every mutation appends one line to the journal. Every
+    STORAGE_COMPACT_EVERY mutations the journal is moved aside and a
+    thread folds it into the snapshot on disk, so the event loop never
+    writes the whole data set; on load and on close the snapshot is
+    written from memory instead. Snapshots are written to a temp file and
+    atomically renamed over the old one. Mutations store whole values, so
+    replaying a journal over a snapshot that already contains it is
+    harmless.
+    """
+    
+    def __init__(self, path: str = DATA_FILE, compact_every: int = STORAGE_COMPACT_EVERY):
+        self.path = path
+        self.journal_path = path + '.journal'
+        # Journal segment waiting to be folded into the snapshot
+        self.old_journal_path = self.journal_path + '.old'
+        self.compact_every = compact_every
+        self.data = None
+        self.journal = None
+        self.pending = 0
+        self.compactor: Optional[asyncio.Task] = None
+        # Held while a snapshot is written, by the loop or the compactor thread
+        self.snapshot_lock = threading.Lock()
+    
+    def load(self) -> dict:
+        """Load the snapshot and replay the journal"""
+        data = read_snapshot(self.path)
+        journal_used = replay_journal(data, self.old_journal_path)
+        journal_used = replay_journal(data, self.journal_path) or journal_used
+        
+        self.data = data
+        if journal_used:
+            self.compact()
+        else:
+            self.journal = open(self.journal_path, 'a')
+        return data
+    
+    def _append(self, entry: dict):
+        started = time.monotonic()
+        self.journal.write(json.dumps(entry) + '\n')
+        self.journal.flush()
+        STORAGE_LATENCY.observe(time.monotonic() - started, operation='journal_append')
+        self.pending += 1
+        if self.pending >= self.compact_every:
+            self.compact_in_background()
+    
+    def put(self, section: str, key, value=None):
+        """Persist an entry"""
+        self._append({'op': 'put', 'section': section, 'key': key, 'value': value})
+    
+    def delete(self, section: str, key):
+        """Persist the removal of an entry"""
+        self._append({'op': 'delete', 'section': section, 'key': key})
+    
+    def compact_in_background(self):
+        """Move the journal aside and fold it into the snapshot in a thread
+        
+        Without a running event loop (start-up, shutdown) the snapshot is
+        written from memory right away.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.compact()
+            return
+        if self.compactor is not None and not self.compactor.done():
+            return
+        # A segment left by a failed run is folded before a new one is cut
+        if not os.path.exists(self.old_journal_path):
+            self.journal.close()
+            os.replace(self.journal_path, self.old_journal_path)
+            self.journal = open(self.journal_path, 'w')
+            self.pending = 0
+        self.compactor = loop.create_task(self._fold_old_journal())
+    
+    async def _fold_old_journal(self):
+        started = time.monotonic()
+        try:
+            await asyncio.to_thread(self._fold_journal_segment)
+        except Exception as e:
+            logger.error(f"Storage compaction failed: {e}")
+        STORAGE_LATENCY.observe(time.monotonic() - started, operation='background_compact')
+    
+    def _fold_journal_segment(self):
+        """Rewrite the snapshot with the old journal segment applied"""
+        with self.snapshot_lock:
+            data = read_snapshot(self.path)
+            if not replay_journal(data, self.old_journal_path):
+                # Already covered by a snapshot written from memory
+                return
+            write_snapshot(data, self.path)
+            os.remove(self.old_journal_path)
+    
+    def compact(self):
+        """Write a fresh snapshot from memory and reset the journal"""
+        started = time.monotonic()
+        with self.snapshot_lock:
+            write_snapshot(self.data, self.path)
+            if self.journal:
+                self.journal.close()
+            self.journal = open(self.journal_path, 'w')
+            if os.path.exists(self.old_journal_path):
+                os.remove(self.old_journal_path)
+        self.pending = 0
+        STORAGE_LATENCY.observe(time.monotonic() - started, operation='compact')
+    
+    def close(self):
+        """Compact and release the journal"""
+        if self.journal:
+            self.compact()
+            self.journal.close()
+            self.journal = None
+
+class SQLiteStorage:
+    """SQLite key-value storage in WAL mode"""
+    
+    def __init__(self, path: str = DB_FILE):
+        self.path = path
+        self.conn = None
+    
+    def load(self) -> dict:
+        """Open the database, migrating bot_data.json on first use"""
+        self.conn = sqlite3.connect(self.path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            "section TEXT NOT NULL, key TEXT NOT NULL, value TEXT, "
+            "PRIMARY KEY (section, key))"
+        )
+        
+        rows = self.conn.execute("SELECT section, key, value FROM kv").fetchall()
+        if not rows and os.path.exists(DATA_FILE):
+            legacy = JsonStorage(DATA_FILE)
+            try:
+                self._migrate(legacy.load())
+            finally:
+                legacy.close()
+            rows = self.conn.execute("SELECT section, key, value FROM kv").fetchall()
+        
+        data = default_data()
+        for section, key, value in rows:
+            if section in LIST_SECTIONS:
+                apply_mutation(data, 'put', section, int(key))
+            else:
+                apply_mutation(data, 'put', section, key, json.loads(value))
+        return data
+    
+    def _migrate(self, data: dict):
+        logger.info(f"Migrating {DATA_FILE} into {self.path}")
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO kv (section, key, value) VALUES (?, ?, ?)",
+                [(section, str(key), json.dumps(value)) for section, key, value in iter_entries(data)]
+            )
+    
+    def put(self, section: str, key, value=None):
+        """Persist an entry"""
+        # Autocommit mode: each statement is its own transaction
+        started = time.monotonic()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO kv (section, key, value) VALUES (?, ?, ?)",
+            (section, str(key), json.dumps(value))
+        )
+        STORAGE_LATENCY.observe(time.monotonic() - started, operation='sqlite_put')
+    
+    def delete(self, section: str, key):
+        """Persist the removal of an entry"""
+        started = time.monotonic()
+        self.conn.execute("DELETE FROM kv WHERE section = ? AND key = ?", (section, str(key)))
+        STORAGE_LATENCY.observe(time.monotonic() - started, operation='sqlite_delete')
+    
+    def compact(self):
+        """Checkpoint the write-ahead log into the database"""
+        started = time.monotonic()
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        STORAGE_LATENCY.observe(time.monotonic() - started, operation='compact')
+    
+    def close(self):
+        """Checkpoint and close the database"""
+        if self.conn:
+            self.compact()
+            self.conn.close()
+            self.conn = None
+
+def usage_counters(model: str, tokens: int, source: str = 'api') -> Dict[str, int]:
+    """Counter increments for one logged request"""
+    counters = {
+        'total_requests': 1,
+        'total_tokens': tokens,
+        f'model:{model}:requests': 1,
+        f'model:{model}:tokens': tokens
+    }
+    if source != 'api':
+        counters[f'{source}_hits'] = 1
+    return counters
+
+def usage_to_counters(stats: dict) -> Dict[str, int]:
+    """Flatten a usage_stats entry into counters"""
+    counters = {key: value for key, value in stats.items() if key not in ('by_model', 'day', 'day_tokens')}
+    for model, model_stats in stats.get('by_model', {}).items():
+        for kind, value in model_stats.items():
+            counters[f'model:{model}:{kind}'] = value
+    return counters
+
+def usage_from_counters(counters: dict) -> Optional[dict]:
+    """Rebuild a usage_stats entry from counters"""
+    if not counters:
+        return None
+    stats = {'total_requests': 0, 'total_tokens': 0, 'by_model': {}}
+    for field, value in counters.items():
+        if field.startswith('model:'):
+            model, _, kind = field[len('model:'):].rpartition(':')
+            stats['by_model'].setdefault(model, {'requests': 0, 'tokens': 0})[kind] = int(value)
+        else:
+            stats[field] = int(value)
+    return stats
+
+class RedisStorage:
+    """Storage shared by several workers through a Redis-compatible server
+    
+    Id sections are sets and all other sections are hashes of JSON values,
+    stored under REDIS_PREFIX; bot_data.json is imported once, on first
+    use. Every mutation is also published on the changes channel so the
+    other workers can apply it to their in-memory copy (see
+    sync_shared_state). Usage counters live in one hash per user and are
+    only ever incremented.
+    
+    Mutations are queued and written in order by a background task, so
+    handlers never wait on the server; reads made while serving requests
+    use the async client.
+    """
+    
+    def __init__(self, url: str = REDIS_URL, prefix: str = REDIS_PREFIX, client=None, async_client=None):
+        if client is None or async_client is None:
+            if redis is None:
+                raise RuntimeError("STORAGE_BACKEND=redis requires the redis package (pip install redis)")
+            client = client or redis.Redis.from_url(url, decode_responses=True)
+            async_client = async_client or redis.asyncio.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.client = client
+        self.async_client = async_client
+        self.channel = f"{prefix}:changes"
+        # Queued mutations, each a function adding its commands to a pipeline
+        self.pending_writes = []
+        self.writer: Optional[asyncio.Task] = None
+    
+    def key(self, name: str) -> str:
+        return f"{self.prefix}:{name}"
+    
+    def load(self) -> dict:
+        """Read all sections, migrating bot_data.json on first use"""
+        sections = [
+            key[len(self.prefix) + 1:] for key in self.client.scan_iter(match=self.key('*'))
+            # Usage counters, claims and leases have namespaced keys
+            if ':' not in key[len(self.prefix) + 1:]
+        ]
+        if not sections and not self.client.exists(self.key('meta:migrated')) and os.path.exists(DATA_FILE):
+            legacy = JsonStorage(DATA_FILE)
+            try:
+                self._migrate(legacy.load())
+            finally:
+                legacy.close()
+            return self.load()
+        
+        data = default_data()
+        data['usage_stats'] = {}
+        for section in sections:
+            if section in LIST_SECTIONS:
+                data[section] = {int(member) for member in self.client.smembers(self.key(section))}
+            else:
+                data[section] = {
+                    key: json.loads(value) for key, value in self.client.hgetall(self.key(section)).items()
+                }
+        return data
+    
+    def _migrate(self, data: dict):
+        logger.info(f"Migrating {DATA_FILE} into {REDIS_URL}")
+        pipe = self.client.pipeline()
+        for section, key, value in iter_entries(data):
+            if section == 'usage_stats':
+                pipe.hset(self.key(f'usage:{key}'), mapping=usage_to_counters(value))
+            elif section in LIST_SECTIONS:
+                pipe.sadd(self.key(section), key)
+            else:
+                pipe.hset(self.key(section), key, json.dumps(value))
+        # Data with no entries outside usage counters would otherwise be imported forever
+        pipe.set(self.key('meta:migrated'), int(time.time()))
+        pipe.execute()
+    
+    def _write(self, build):
+        """Queue a mutation for the background writer
+        
+        Without a running event loop (start-up, shutdown) it is written
+        right away.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            pipe = self.client.pipeline()
+            build(pipe)
+            pipe.execute()
+            return
+        self.pending_writes.append(build)
+        if self.writer is None or self.writer.done():
+            self.writer = loop.create_task(self._write_pending())
+    
+    async def _write_pending(self):
+        """Write queued mutations in order, as many per round trip as are waiting"""
+        failures = 0
+        while self.pending_writes:
+            builds, self.pending_writes = self.pending_writes, []
+            pipe = self.async_client.pipeline()
+            for build in builds:
+                build(pipe)
+            started = time.monotonic()
+            try:
+                await pipe.execute()
+                STORAGE_LATENCY.observe(time.monotonic() - started, operation='redis_write')
+                failures = 0
+            except asyncio.CancelledError:
+                # Left for close() to write
+                self.pending_writes[:0] = builds
+                raise
+            except Exception as e:
+                failures += 1
+                if failures > 3:
+                    logger.error(f"Dropping {len(builds)} shared state writes: {e}")
+                    failures = 0
+                    continue
+                logger.warning(f"Shared state write failed, retrying: {e}")
+                self.pending_writes[:0] = builds
+                await asyncio.sleep(failures)
+    
+    async def drain(self):
+        """Wait until the queued mutations are written"""
+        if self.writer is not None:
+            await asyncio.shield(self.writer)
+    
+    def _publish(self, pipe, message: str):
+        pipe.publish(self.channel, message)
+    
+    def _change(self, op: str, section: str, key, value=None) -> str:
+        return json.dumps({'worker': WORKER_ID, 'op': op, 'section': section, 'key': key, 'value': value})
+    
+    def put(self, section: str, key, value=None):
+        """Persist an entry and announce it to the other workers"""
+        # Serialized now; callers may change value after this returns
+        payload, change = json.dumps(value), self._change('put', section, key, value)
+        
+        def build(pipe):
+            if section in LIST_SECTIONS:
+                pipe.sadd(self.key(section), key)
+            else:
+                pipe.hset(self.key(section), key, payload)
+            self._publish(pipe, change)
+        self._write(build)
+    
+    def delete(self, section: str, key):
+        """Persist the removal of an entry and announce it to the other workers"""
+        change = self._change('delete', section, key)
+        
+        def build(pipe):
+            if section in LIST_SECTIONS:
+                pipe.srem(self.key(section), key)
+            else:
+                pipe.hdel(self.key(section), key)
+            self._publish(pipe, change)
+        self._write(build)
+    
+    def increment_usage(self, increments: Dict[str, Dict[str, int]], daily: Dict[tuple, int]):
+        """Add buffered counter increments, keyed by user id, and daily
+        token counts, keyed by (user id, day)"""
+        def build(pipe):
+            for user_id_str, counters in increments.items():
+                for field, amount in counters.items():
+                    pipe.hincrby(self.key(f'usage:{user_id_str}'), field, amount)
+            for (user_id_str, day), tokens in daily.items():
+                pipe.incrby(self.key(f'usage:{user_id_str}:{day}'), tokens)
+                pipe.expire(self.key(f'usage:{user_id_str}:{day}'), 2 * 86400)
+        self._write(build)
+    
+    async def get_daily_tokens(self, user_id_str: str, day: str) -> int:
+        """Get the tokens a user spent on a day"""
+        return int(await self.async_client.get(self.key(f'usage:{user_id_str}:{day}')) or 0)
+    
+    async def get_usage(self, user_id_str: str) -> dict:
+        """Get a user's usage counters"""
+        return await self.async_client.hgetall(self.key(f'usage:{user_id_str}'))
+    
+    async def acquire(self, name: str, ttl: float) -> bool:
+        """Take or renew a lease held by this worker"""
+        key = self.key(f'lease:{name}')
+        if await self.async_client.set(key, WORKER_ID, nx=True, px=int(ttl * 1000)):
+            return True
+        if await self.async_client.get(key) == WORKER_ID:
+            await self.async_client.pexpire(key, int(ttl * 1000))
+            return True
+        return False
+    
+    async def release(self, name: str):
+        """Give up a lease held by this worker"""
+        key = self.key(f'lease:{name}')
+        if await self.async_client.get(key) == WORKER_ID:
+            await self.async_client.delete(key)
+    
+    async def claim(self, name: str, ttl: int = UPDATE_CLAIM_TTL) -> bool:
+        """Claim a one-off piece of work; only the first worker succeeds"""
+        return bool(await self.async_client.set(self.key(f'claim:{name}'), WORKER_ID, nx=True, ex=ttl))
+    
+    def compact(self):
+        """Nothing to do; the server handles its own persistence"""
+    
+    def close(self):
+        """Write mutations still queued and close the connection pool"""
+        if self.pending_writes:
+            pipe = self.client.pipeline()
+            for build in self.pending_writes:
+                build(pipe)
+            pipe.execute()
+            self.pending_writes = []
+        self.client.close()
+    
+    async def aclose(self):
+        """Close the async client and its connection pool"""
+        await self.async_client.aclose()
+
+STORAGE_BACKENDS = {
+    'json': JsonStorage,
+    'sqlite': SQLiteStorage,
+    'redis': RedisStorage,
+}
+
+def create_storage():
+    """Create the storage backend selected by STORAGE_BACKEND"""
+    try:
+        return STORAGE_BACKENDS[STORAGE_BACKEND]()
+    except KeyError:
+        raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
 
 class BotData:
     """Manages bot data storage"""
     
-    def __init__(self):
+    def __init__(self, storage=None):
+        self.storage = storage or create_storage()
         self.data = self.load_data()
+        # Usage stats changed since the last flush
+        self.dirty_usage = set()
+        self.pending_usage = 0
         
     def load_data(self) -> dict:
-        """Load data from file"""
-        try:
-            with open(DATA_FILE, 'r') as f:
-                return json.load(f)
-        except FileNotFoundError:
-            return {
-                'authorized_users': [],
-                'authorized_groups': [],
-                'user_preferences': {},
-                'usage_stats': {},
-                'banned_users': [],
-                'user_api_keys': {}
-            }
+        """Load data from storage"""
+        return self.storage.load()
     
-    def save_data(self):
-        """Save data to file"""
-        with open(DATA_FILE, 'w') as f:
-            json.dump(self.data, f, indent=2)
+    def flush_usage(self):
+        """Persist buffered usage statistics"""
+        if not self.dirty_usage:
+            self.pending_usage = 0
+            return
+        started = time.monotonic()
+        usage_stats = self.data['usage_stats']
+        for user_id_str in self.dirty_usage:
+            self.storage.put('usage_stats', user_id_str, usage_stats[user_id_str])
+        self.dirty_usage.clear()
+        self.pending_usage = 0
+        STORAGE_LATENCY.observe(time.monotonic() - started, operation='flush_usage')
+    
+    def close(self):
+        """Flush buffered writes and close storage"""
+        self.flush_usage()
+        self.storage.close()
+    
+    def check_access(self, user_id: int, group_id: Optional[int] = None) -> bool:
+        """Authorization check for an update
+        
+        Updates from private chats check the user, updates from groups
+        check the group. All lookups are set membership tests.
+        """
+        if group_id is not None:
+            return self.is_group_authorized(group_id)
+        return self.is_user_authorized(user_id)
     
     def is_user_authorized(self, user_id: int) -> bool:
         """Check if user is authorized"""
@@ -86,38 +1052,100 @@ class BotData:
     def authorize_user(self, user_id: int):
         """Authorize a user"""
         if user_id not in self.data['authorized_users']:
-            self.data['authorized_users'].append(user_id)
-            self.save_data()
+            self.data['authorized_users'].add(user_id)
+            self.storage.put('authorized_users', user_id)
     
     def authorize_group(self, chat_id: int):
         """Authorize a group"""
         if chat_id not in self.data['authorized_groups']:
-            self.data['authorized_groups'].append(chat_id)
-            self.save_data()
+            self.data['authorized_groups'].add(chat_id)
+            self.storage.put('authorized_groups', chat_id)
     
     def revoke_user(self, user_id: int):
         """Revoke user authorization"""
         if user_id in self.data['authorized_users']:
-            self.data['authorized_users'].remove(user_id)
-            self.save_data()
+            self.data['authorized_users'].discard(user_id)
+            self.storage.delete('authorized_users', user_id)
     
     def revoke_group(self, chat_id: int):
         """Revoke group authorization"""
         if chat_id in self.data['authorized_groups']:
-            self.data['authorized_groups'].remove(chat_id)
-            self.save_data()
+            self.data['authorized_groups'].discard(chat_id)
+            self.storage.delete('authorized_groups', chat_id)
     
     def ban_user(self, user_id: int):
         """Ban a user"""
         if user_id not in self.data['banned_users']:
-            self.data['banned_users'].append(user_id)
-            self.save_data()
+            self.data['banned_users'].add(user_id)
+            self.storage.put('banned_users', user_id)
     
     def unban_user(self, user_id: int):
         """Unban a user"""
         if user_id in self.data['banned_users']:
-            self.data['banned_users'].remove(user_id)
-            self.save_data()
+            self.data['banned_users'].discard(user_id)
+            self.storage.delete('banned_users', user_id)
+    
+    def get_authorized_users(self) -> List[int]:
+        """Get a snapshot of all authorized user ids"""
+        return list(self.data['authorized_users'])
+    
+    async def acquire_lease(self, name: str, ttl: float) -> bool:
+        """Take or renew a named lease; a single process always holds it"""
+        return True
+    
+    async def release_lease(self, name: str):
+        """Give up a named lease"""
+    
+    def get_broadcast(self) -> Optional[dict]:
+        """Get the state of an unfinished broadcast"""
+        return self.data.get('broadcasts', {}).get('current')
+    
+    def save_broadcast(self, state: dict):
+        """Persist the state of a running broadcast"""
+        self.data.setdefault('broadcasts', {})['current'] = state
+        self.storage.put('broadcasts', 'current', state)
+    
+    def clear_broadcast(self):
+        """Forget a finished broadcast"""
+        if self.data.get('broadcasts', {}).pop('current', None) is not None:
+            self.storage.delete('broadcasts', 'current')
+    
+    def queue_batch_request(self, request: dict):
+        """Persist a prompt waiting to be submitted in a batch job"""
+        self.data.setdefault('batch_queue', {})[request['custom_id']] = request
+        self.storage.put('batch_queue', request['custom_id'], request)
+    
+    def get_batch_queue(self) -> List[dict]:
+        """Get the prompts waiting to be submitted, oldest first"""
+        return sorted(self.data.get('batch_queue', {}).values(), key=lambda request: request['queued'])
+    
+    def dequeue_batch_request(self, custom_id: str):
+        """Forget a prompt that was submitted or given up on"""
+        if self.data.get('batch_queue', {}).pop(custom_id, None) is not None:
+            self.storage.delete('batch_queue', custom_id)
+    
+    def get_batch_jobs(self) -> List[dict]:
+        """Get the submitted batch jobs whose answers are not delivered yet"""
+        return list(self.data.get('batch_jobs', {}).values())
+    
+    def save_batch_job(self, job: dict):
+        """Persist the state of a batch job"""
+        self.data.setdefault('batch_jobs', {})[job['id']] = job
+        self.storage.put('batch_jobs', job['id'], job)
+    
+    def delete_batch_job(self, job_id: str):
+        """Forget a batch job whose answers were delivered"""
+        if self.data.get('batch_jobs', {}).pop(job_id, None) is not None:
+            self.storage.delete('batch_jobs', job_id)
+    
+    def count_batch_requests(self, user_id: int) -> int:
+        """Count a user's prompts that are queued or in a batch job"""
+        queued = sum(1 for request in self.data.get('batch_queue', {}).values() if request['user_id'] == user_id)
+        submitted = sum(
+            1 for job in self.data.get('batch_jobs', {}).values()
+            for request in job['requests'].values() if request['user_id'] == user_id
+        )
+        return queued + submitted
     
     def get_user_model(self, user_id: int) -> str:
         """Get user's preferred model"""
@@ -129,10 +1157,16 @@ class BotData:
         if user_id_str not in self.data['user_preferences']:
             self.data['user_preferences'][user_id_str] = {}
         self.data['user_preferences'][user_id_str]['model'] = model
-        self.save_data()
+        self.storage.put('user_preferences', user_id_str, self.data['user_preferences'][user_id_str])
     
-    def log_usage(self, user_id: int, model: str, tokens: int):
-        """Log API usage"""
+    def log_usage(self, user_id: int, model: str, tokens: int, source: str = 'api'):
+        """Log API usage
+        
+        Counters are updated in memory right away and written to storage
+        in batches of USAGE_FLUSH_BATCH or by usage_flush_loop. Requests not
+        served by the API (source other than 'api') are also counted as
+        '<source>_hits'.
+        """
         user_id_str = str(user_id)
         if user_id_str not in self.data['usage_stats']:
             self.data['usage_stats'][user_id_str] = {
@@ -150,14 +1184,39 @@ class BotData:
         
         stats['by_model'][model]['requests'] += 1
         stats['by_model'][model]['tokens'] += tokens
-        self.save_data()
+        
+        if source != 'api':
+            stats[f'{source}_hits'] = stats.get(f'{source}_hits', 0) + 1
+        
+        today = utc_day()
+        if stats.get('day') != today:
+            stats['day'] = today
+            stats['day_tokens'] = 0
+        stats['day_tokens'] += tokens
+        
+        self.dirty_usage.add(user_id_str)
+        self.pending_usage += 1
+        if self.pending_usage >= USAGE_FLUSH_BATCH:
+            self.flush_usage()
+    
+    async def get_usage_stats(self, user_id: int) -> Optional[dict]:
+        """Get user's usage statistics, including unflushed requests"""
+        return self.data['usage_stats'].get(str(user_id))
+    
+    async def get_tokens_today(self, user_id: int) -> int:
+        """Get the tokens a user spent since midnight UTC"""
+        stats = self.data['usage_stats'].get(str(user_id))
+        if not stats or stats.get('day') != utc_day():
+            return 0
+        return stats['day_tokens']
     
     def set_user_api_key(self, user_id: int, api_key: str):
         """Set user's personal OpenAI API key"""
         if 'user_api_keys' not in self.data:
             self.data['user_api_keys'] = {}
         self.data['user_api_keys'][str(user_id)] = api_key
-        self.save_data()
+        self.storage.put('user_api_keys', str(user_id), api_key)
+        openai_clients.invalidate(user_id)
     
     def get_user_api_key(self, user_id: int) -> Optional[str]:
         """Get user's personal OpenAI API key"""
@@ -172,7 +1231,8 @@ class BotData:
         user_id_str = str(user_id)
         if user_id_str in self.data['user_api_keys']:
             del self.data['user_api_keys'][user_id_str]
-            self.save_data()
+            self.storage.delete('user_api_keys', user_id_str)
+            openai_clients.invalidate(user_id)
     
     def has_user_api_key(self, user_id: int) -> bool:
         """Check if user has a personal API key set"""
@@ -180,8 +1240,86 @@ class BotData:
             self.data['user_api_keys'] = {}
         return str(user_id) in self.data['user_api_keys']
 
-# Initialize bot data
-bot_data = BotData()
+class SharedBotData(BotData):
+    """Bot data shared by several workers through RedisStorage
+    
+    Reads are served from the in-memory copy, which sync_shared_state keeps
+    up to date with the other workers' changes. Usage is buffered as
+    counter increments and added with HINCRBY, so concurrent workers never
+    overwrite each other's counts.
+    """
+    
+    def __init__(self, storage: Optional[RedisStorage] = None):
+        super().__init__(storage or RedisStorage())
+        self.usage_increments = {}
+        self.daily_increments = {}
+    
+    async def reload(self):
+        """Replace the in-memory copy with the current shared state"""
+        # Our own queued writes would otherwise be rolled back
+        await self.storage.drain()
+        fresh = await asyncio.to_thread(self.storage.load)
+        for section, content in fresh.items():
+            current = self.data.setdefault(section, content)
+            # Update in place; ConversationStore holds on to its section
+            if current is not content:
+                current.clear()
+                current.update(content)
+        # Sections emptied by other workers have no key left on the server
+        for section, current in self.data.items():
+            if section not in fresh:
+                current.clear()
+    
+    def apply_change(self, op: str, section: str, key, value=None):
+        """Apply a change published by another worker"""
+        apply_mutation(self.data, op, section, key, value)
+        if section == 'user_api_keys':
+            openai_clients.invalidate(int(key))
+    
+    def flush_usage(self):
+        """Queue buffered usage counters for the shared store"""
+        if self.usage_increments:
+            self.storage.increment_usage(self.usage_increments, self.daily_increments)
+            self.usage_increments = {}
+            self.daily_increments = {}
+        self.pending_usage = 0
+    
+    def log_usage(self, user_id: int, model: str, tokens: int, source: str = 'api'):
+        """Log API usage"""
+        counters = self.usage_increments.setdefault(str(user_id), {})
+        for field, amount in usage_counters(model, tokens, source).items():
+            counters[field] = counters.get(field, 0) + amount
+        day_key = (str(user_id), utc_day())
+        self.daily_increments[day_key] = self.daily_increments.get(day_key, 0) + tokens
+        self.pending_usage += 1
+        if self.pending_usage >= USAGE_FLUSH_BATCH:
+            self.flush_usage()
+    
+    async def get_usage_stats(self, user_id: int) -> Optional[dict]:
+        """Get user's usage statistics across all workers"""
+        if str(user_id) in self.usage_increments:
+            self.flush_usage()
+        await self.storage.drain()
+        return usage_from_counters(await self.storage.get_usage(str(user_id)))
+    
+    async def get_tokens_today(self, user_id: int) -> int:
+        """Get the tokens a user spent since midnight UTC on all workers
+        
+        Tokens flushed but still queued for writing are briefly missed.
+        """
+        day_key = (str(user_id), utc_day())
+        return await self.storage.get_daily_tokens(*day_key) + self.daily_increments.get(day_key, 0)
+    
+    async def acquire_lease(self, name: str, ttl: float) -> bool:
+        """Take or renew a named lease shared by all workers"""
+        return await self.storage.acquire(name, ttl)
+    
+    async def release_lease(self, name: str):
+        """Give up a named lease"""
+        await self.storage.release(name)
+
+# Bot data, loaded by load_state()
+bot_data: Optional[BotData] = None
 
 # Available AI models
 AVAILABLE_MODELS = {
@@ -194,48 +1332,1454 @@ AVAILABLE_MODELS = {
     'o1-mini': '🎓 O1 Mini (Fast Reasoning)',
 }
 
-# Initialize Pyrogram client
-app = Client(
-    "ai_assistant_bot",
-    api_id=API_ID,
-    api_hash=API_HASH,
-    bot_token=BOT_TOKEN
-)
+# Context window sizes (tokens) of the available models
+MODEL_CONTEXT_WINDOWS = {
+    'gpt-4o': 128000,
+    'gpt-4o-mini': 128000,
+    'gpt-4-turbo': 128000,
+    'gpt-4': 8192,
+    'gpt-3.5-turbo': 16385,
+    'o1-preview': 128000,
+    'o1-mini': 128000,
+}
+
+# USD per million (prompt, completion) tokens, for cost estimates
+MODEL_PRICING = {
+    'gpt-4o': (2.50, 10.00),
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4-turbo': (10.00, 30.00),
+    'gpt-4': (30.00, 60.00),
+    'gpt-3.5-turbo': (0.50, 1.50),
+    'o1-preview': (15.00, 60.00),
+    'o1-mini': (3.00, 12.00),
+}
+
+# Cheaper model to fall back to when a model is failing
+MODEL_FALLBACKS = {
+    'gpt-4o': 'gpt-4o-mini',
+    'gpt-4-turbo': 'gpt-4o-mini',
+    'gpt-4': 'gpt-4o-mini',
+    'o1-preview': 'o1-mini',
+    'o1-mini': 'gpt-4o-mini',
+    'gpt-4o-mini': 'gpt-3.5-turbo',
+}
+
+def fallback_chain(model: str) -> List[str]:
+    """The model followed by its fallbacks, cheapest last"""
+    chain = [model]
+    while MODEL_FALLBACKS.get(chain[-1]) and MODEL_FALLBACKS[chain[-1]] not in chain:
+        chain.append(MODEL_FALLBACKS[chain[-1]])
+    return chain
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate for a piece of text"""
+    return len(text) // 4 + 1
+
+# Tokenizers loaded by load_encoding, by model
+encodings: Dict[str, object] = {}
+
+def load_encoding(model: str):
+    """Load the tokenizer for a model; None if it is unavailable
+    
+    Encodings are downloaded on first use, so this runs in a thread (see
+    load_tokenizers). Failures are not remembered; the next call tries
+    again.
+    """
+    if tiktoken is None:
+        return None
+    encoding = encodings.get(model)
+    if encoding is None:
+        try:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = tiktoken.get_encoding('o200k_base')
+        except Exception as e:
+            logger.warning(f"No tokenizer for {model} yet, estimating token counts: {e}")
+            return None
+        encodings[model] = encoding
+    return encoding
+
+def get_encoding(model: str):
+    """Tokenizer for a model if it is already loaded, else None"""
+    return encodings.get(model)
+
+# Exact token counts by (model, text), least recently used first
+token_counts: "OrderedDict[tuple, int]" = OrderedDict()
+
+def count_tokens(text: str, model: str = '') -> int:
+    """Tokens in a piece of text
+    
+    Exact counts are memoized, so system prompts and conversation history
+    already counted on an earlier turn cost a dictionary lookup. Until the
+    model's encoding is loaded the count is estimated, and not memoized.
+    """
+    key = (model, text)
+    tokens = token_counts.get(key)
+    if tokens is not None:
+        token_counts.move_to_end(key)
+        return tokens
+    encoding = get_encoding(model) if model else None
+    if encoding is None:
+        return estimate_tokens(text)
+    tokens = len(encoding.encode(text, disallowed_special=()))
+    remember_tokens(key, tokens)
+    return tokens
+
+def remember_tokens(key: tuple, tokens: int):
+    """Memoize an exact token count, keyed by (model, text)"""
+    token_counts[key] = tokens
+    token_counts.move_to_end(key)
+    if len(token_counts) > TOKEN_COUNT_CACHE_SIZE:
+        token_counts.popitem(last=False)
+
+def exact_token_counts(texts: list, model: str) -> Optional[List[int]]:
+    """Exact token counts of texts; None if the model's encoding is not loaded"""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return None
+    return [len(encoding.encode(text, disallowed_special=())) for text in texts]
+
+def message_tokens(message: dict, model: str = '') -> int:
+    """Tokens in a chat message, including framing"""
+    return count_tokens(message['content'], model) + 4
+
+def prompt_tokens(messages: list, model: str = '') -> int:
+    """Tokens in a prompt, including the reply priming"""
+    return sum(message_tokens(message, model) for message in messages) + 3
+
+def estimate_cost(model: str, prompt: int, completion: int) -> float:
+    """Estimated price of a request in USD"""
+    prompt_price, completion_price = MODEL_PRICING.get(model, (0.0, 0.0))
+    return (prompt * prompt_price + completion * completion_price) / 1_000_000
+
+def warm_tokenizers() -> bool:
+    """Load the encodings of all available models; True once nothing is left to load"""
+    if tiktoken is None:
+        return True
+    return all([load_encoding(model) is not None for model in AVAILABLE_MODELS])
+
+def history_budget(model: str, max_tokens: int = 2000) -> int:
+    """Tokens of conversation history that fit in a model's context"""
+    window = MODEL_CONTEXT_WINDOWS.get(model, 8192)
+    return max(0, min(CONVERSATION_HISTORY_TOKENS, window - max_tokens - 500))
+
+def trim_history(history: list, budget: int, model: str = '') -> list:
+    """Drop the oldest turns until the history fits in the token budget"""
+    total = 0
+    start = len(history)
+    for i in range(len(history) - 1, -1, -1):
+        total += message_tokens(history[i], model)
+        if total > budget:
+            break
+        start = i
+    trimmed = history[start:]
+    # Never open the context with an orphaned assistant reply
+    while trimmed and trimmed[0]['role'] != 'user':
+        trimmed = trimmed[1:]
+    return trimmed
+
+# Pool running CPU-bound pure functions off the event loop; see start_process_pool
+process_pool: Optional[ProcessPoolExecutor] = None
+
+def start_process_pool():
+    """Fork WORKER_PROCESSES worker processes
+    
+    Workers are forked, so they share the already imported module instead
+    of importing it again (which would reload storage and create clients).
+    A forking pool starts all of its processes on the first submission,
+    so main() runs this before any threads (logging, Telegram) start.
+    Each worker then loads the tokenizers itself.
+    """
+    global process_pool
+    if WORKER_PROCESSES <= 0:
+        return
+    process_pool = ProcessPoolExecutor(
+        WORKER_PROCESSES, mp_context=multiprocessing.get_context('fork'), initializer=warm_tokenizers
+    )
+    # Forks the workers; not waited for, as they may be downloading encodings
+    process_pool.submit(int)
+    logger.info(f"Started {WORKER_PROCESSES} worker processes")
+
+def stop_process_pool():
+    """Shut the worker processes down"""
+    global process_pool
+    if process_pool is not None:
+        process_pool.shutdown(cancel_futures=True)
+        process_pool = None
+
+async def offload(func, *args):
+    """Run a CPU-bound pure function in a worker process, if there are any
+    
+    Arguments and results are pickled, so callers only offload inputs of
+    at least OFFLOAD_MIN_CHARS characters.
+    """
+    if process_pool is None:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(process_pool, func, *args)
+
+async def prime_token_counts(texts: list, model: str):
+    """Count long texts that are not memoized yet in a worker process
+    
+    Only worth it from OFFLOAD_MIN_CHARS characters of new text; the
+    count_tokens calls that follow are then dictionary lookups.
+    """
+    if process_pool is None or not model:
+        return
+    missing = list({text for text in texts if (model, text) not in token_counts})
+    if sum(len(text) for text in missing) < OFFLOAD_MIN_CHARS:
+        return
+    counts = await offload(exact_token_counts, missing, model)
+    # None while the workers are still loading their encodings
+    if counts is not None:
+        for text, tokens in zip(missing, counts):
+            remember_tokens((model, text), tokens)
+
+class ConversationStore:
+    """Bounded per-chat message history
+    
+    Chats are kept in least-recently-used order; idle chats expire after
+    CONVERSATION_IDLE_TTL and the least recently used chat is evicted once
+    CONVERSATION_MAX_CHATS is reached. When a BotData instance is given the
+    history is persisted in its 'conversations' section.
+    """
+    
+    def __init__(self, data: Optional[BotData] = None, max_chats: int = CONVERSATION_MAX_CHATS,
+                 max_messages: int = CONVERSATION_MAX_MESSAGES, idle_ttl: float = CONVERSATION_IDLE_TTL):
+        self.bot_data = data
+        self.max_chats = max_chats
+        self.max_messages = max_messages
+        self.idle_ttl = idle_ttl
+        if data is not None:
+            # Oldest first, so dict order doubles as LRU order
+            stored = data.data.setdefault('conversations', {})
+            self.chats = dict(sorted(stored.items(), key=lambda item: item[1]['updated']))
+            data.data['conversations'] = self.chats
+        else:
+            self.chats = {}
+    
+    def _evict(self, key: str):
+        del self.chats[key]
+        if self.bot_data is not None:
+            self.bot_data.storage.delete('conversations', key)
+    
+    def _expire(self):
+        cutoff = time.time() - self.idle_ttl
+        while self.chats:
+            oldest = next(iter(self.chats))
+            if self.chats[oldest]['updated'] >= cutoff and len(self.chats) <= self.max_chats:
+                break
+            self._evict(oldest)
+    
+    def get(self, chat_id: int) -> list:
+        """Get the stored messages of a chat"""
+        self._expire()
+        entry = self.chats.get(str(chat_id))
+        return list(entry['messages']) if entry else []
+    
+    def append(self, chat_id: int, user_text: str, assistant_text: str):
+        """Record a completed exchange"""
+        key = str(chat_id)
+        entry = self.chats.pop(key, None) or {'messages': []}
+        messages = entry['messages']
+        messages.append({"role": "user", "content": user_text})
+        messages.append({"role": "assistant", "content": assistant_text})
+        del messages[:-self.max_messages]
+        entry['updated'] = time.time()
+        self.chats[key] = entry
+        
+        if self.bot_data is not None:
+            self.bot_data.storage.put('conversations', key, entry)
+        self._expire()
+    
+    def clear(self, chat_id: int):
+        """Forget a chat's history"""
+        if str(chat_id) in self.chats:
+            self._evict(str(chat_id))
+    
+    async def build_messages(self, chat_id: int, system_prompt: str, user_text: str,
+                             model: str, max_tokens: int = 2000) -> list:
+        """Build a prompt from the system prompt, trimmed history and new message"""
+        history = self.get(chat_id)
+        await prime_token_counts([system_prompt, user_text, *(message['content'] for message in history)], model)
+        budget = history_budget(model, max_tokens) - count_tokens(system_prompt, model) - count_tokens(user_text, model)
+        history = trim_history(history, budget, model)
+        return [
+            {"role": "system", "content": system_prompt},
+            *history,
+            {"role": "user", "content": user_text}
+        ]
+
+# Created by load_state() once bot data is loaded
+conversations: Optional[ConversationStore] = None
+
+# Initialize Pyrogram client
+app = Client(
+    BOT_SESSION_NAME,
+    api_id=API_ID,
+    api_hash=API_HASH,
+    bot_token=BOT_TOKEN,
+    workers=BOT_WORKERS
+)
+
+# Work handed off by update handlers, so dispatcher workers return at once
+background_tasks = set()
+
+def _background_task_done(task: asyncio.Task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Background task failed: {task.exception()}", exc_info=task.exception())
+
+def spawn(coro) -> asyncio.Task:
+    """Run a coroutine in a task that is kept alive until it ends"""
+    task = asyncio.get_running_loop().create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(_background_task_done)
+    return task
+
+async def drain_background_tasks(timeout: float = SHUTDOWN_GRACE):
+    """Wait for handed-off work to finish, then cancel what is left"""
+    deadline = time.monotonic() + timeout
+    while background_tasks and time.monotonic() < deadline:
+        await asyncio.wait(list(background_tasks), timeout=deadline - time.monotonic())
+    for task in list(background_tasks):
+        task.cancel()
+    if background_tasks:
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+
+def is_owner(user_id: int) -> bool:
+    """Check if user is the owner"""
+    return user_id == OWNER_ID
+
+def create_model_keyboard() -> InlineKeyboardMarkup:
+    """Create inline keyboard for model selection"""
+    buttons = []
+    for model_id, model_name in AVAILABLE_MODELS.items():
+        buttons.append([InlineKeyboardButton(
+            model_name,
+            callback_data=f"model_{model_id}"
+        )])
+    return InlineKeyboardMarkup(buttons)
+
+def create_main_menu() -> InlineKeyboardMarkup:
+    """Create main menu keyboard"""
+    buttons = [
+        [InlineKeyboardButton("🤖 Change Model", callback_data="change_model")],
+        [InlineKeyboardButton("📊 Usage Stats", callback_data="stats")],
+        [InlineKeyboardButton("ℹ️ Help", callback_data="help")]
+    ]
+    return InlineKeyboardMarkup(buttons)
+
+WELCOME_TEXT = """
+🤖 **Welcome to Advanced AI Assistant Bot!**
+
+Hello {mention}! I'm powered by OpenAI's latest models.
+
+**Features:**
+• 💬 Chat with AI in private or groups
+• 🔍 Inline mode for quick queries
+• 🤖 Multiple AI models to choose from
+• 📊 Track your usage statistics
+
+**Quick Start:**
+• Use /ask <question> to ask me anything
+• Use /model to change AI model
+• Type @{username} <query> in any chat for inline mode
+
+Ready to assist you! 🚀
+"""
+
+HELP_TEXT = """
+📚 **Bot Commands & Features**
+
+**Basic Commands:**
+• `/start` - Start the bot and see main menu
+• `/ask <question>` - Ask AI a question
+• `/batch <question>` - Get the answer later, at half the price
+• `/model` - Change AI model
+• `/stats` - View your usage statistics
+• `/reset` - Clear conversation history
+• `/help` - Show this help message
+
+**API Key Management:**
+• `/setapikey <key>` - Set your personal OpenAI API key
+• `/removeapikey` - Remove your API key
+• `/myapikey` - Check API key status
+
+**Inline Mode:**
+Type `@{username} your question` in any chat to get instant AI responses!
+
+**Owner Commands:**
+• `/auth <user_id>` - Authorize user
+• `/revoke <user_id>` - Revoke user access
+• `/authgroup` - Authorize current group
+• `/revokegroup` - Revoke group access
+• `/ban <user_id>` - Ban user
+• `/unban <user_id>` - Unban user
+• `/broadcast <message>` - Broadcast to all users
+
+**Available Models:**
+{models}
+🔥 Powered by OpenAI's cutting-edge AI technology!"""
+
+class UICache:
+    """Pre-rendered keyboards and texts
+    
+    Everything derived from AVAILABLE_MODELS is rendered once and rebuilt
+    only when the catalog changes. The bot's username is fetched by
+    warm_up() at startup, or on first use, and never again.
+    """
+    
+    def __init__(self):
+        self.catalog = None
+        self.username = None
+        self.main_menu = create_main_menu()
+        self.back_keyboard = InlineKeyboardMarkup([[
+            InlineKeyboardButton("« Back", callback_data="back_to_menu")
+        ]])
+        self.quick_help = (
+            "📚 **Quick Help**\n\n"
+            "• Use /ask to ask questions\n"
+            "• Use /model to change AI model\n"
+            "• Use inline mode for quick queries\n"
+            "• Use /help for detailed instructions"
+        )
+    
+    def _render(self):
+        """Re-render catalog-dependent content if the catalog changed"""
+        catalog = tuple(AVAILABLE_MODELS.items())
+        if catalog == self.catalog:
+            return
+        self.catalog = catalog
+        self._model_keyboard = create_model_keyboard()
+        self._help_text = HELP_TEXT.format(
+            username=self.username or 'botusername',
+            models=''.join(f"• {model_name}\n" for model_name in AVAILABLE_MODELS.values())
+        )
+    
+    async def warm_up(self, client: Client):
+        """Fetch the bot identity and render everything up front"""
+        self.username = (await client.get_me()).username
+        self.catalog = None
+        self._render()
+    
+    async def bot_username(self, client: Client) -> str:
+        """The bot's username, fetched at most once"""
+        if self.username is None:
+            await self.warm_up(client)
+        return self.username
+    
+    def model_keyboard(self) -> InlineKeyboardMarkup:
+        """Keyboard for model selection"""
+        self._render()
+        return self._model_keyboard
+    
+    def help_text(self) -> str:
+        """Text of /help"""
+        self._render()
+        return self._help_text
+    
+    def welcome_text(self, username: str, mention: str) -> str:
+        """Text of /start"""
+        return WELCOME_TEXT.format(username=username, mention=mention)
+
+ui = UICache()
+
+class TTLCache:
+    """Size-bounded LRU cache whose entries expire after a TTL
+    
+    With sliding=True the TTL restarts on every hit, so entries expire
+    after being idle rather than after being stored.
+    """
+    
+    def __init__(self, max_size: int, ttl: float, sliding: bool = False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sliding = sliding
+        self.entries = OrderedDict()
+    
+    def get(self, key, default=None):
+        """Get a live entry, refreshing its LRU position"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        now = time.monotonic()
+        if expires < now:
+            del self.entries[key]
+            return default
+        if self.sliding:
+            self.entries[key] = (now + self.ttl, value)
+        self.entries.move_to_end(key)
+        return value
+    
+    def set(self, key, value):
+        """Store an entry, evicting the least recently used if full"""
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+    
+    def pop(self, key, default=None):
+        """Remove an entry"""
+        entry = self.entries.pop(key, None)
+        return entry[1] if entry else default
+    
+    def clear(self):
+        """Remove all entries"""
+        self.entries.clear()
+    
+    def __len__(self) -> int:
+        return len(self.entries)
+
+class TokenBucket:
+    """Token bucket rate limiter"""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+    
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        """Take tokens if available without waiting"""
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.paused_until or self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+    
+    async def acquire(self, tokens: float = 1.0):
+        """Wait until tokens are available and take them"""
+        while True:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return
+            await asyncio.sleep((tokens - self.tokens) / self.rate)
+    
+    def pause(self, seconds: float):
+        """Hold back all acquirers, e.g. after a FloodWait"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+class AdmissionRejected(Exception):
+    """Raised when admission control turns a request away"""
+
+class AdmissionController:
+    """Per-user and per-group rate limits
+    
+    Rate limits reject immediately. The owner is not rate limited.
+    Concurrency is capped by the RequestScheduler, which queues requests
+    by priority.
+    """
+    
+    def __init__(self):
+        # Idle buckets are dropped; a fresh bucket starts full, like an idle one
+        self.user_buckets = TTLCache(100000, 600, sliding=True)
+        self.group_buckets = TTLCache(10000, 600, sliding=True)
+    
+    @staticmethod
+    def _bucket(buckets: TTLCache, key: int, per_minute: float, burst: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(per_minute / 60, burst)
+            buckets.set(key, bucket)
+        return bucket
+    
+    def check_rate(self, user_id: int, group_id: Optional[int] = None):
+        """Take a request token for the user and group or raise AdmissionRejected"""
+        if is_owner(user_id):
+            return
+        
+        user_bucket = self._bucket(self.user_buckets, user_id, RATE_LIMIT_USER_PER_MIN, RATE_LIMIT_USER_BURST)
+        if not user_bucket.try_acquire():
+            raise AdmissionRejected("⏳ You're sending requests too quickly. Please wait a moment.")
+        
+        if group_id is not None:
+            group_bucket = self._bucket(self.group_buckets, group_id, RATE_LIMIT_GROUP_PER_MIN, RATE_LIMIT_GROUP_BURST)
+            if not group_bucket.try_acquire():
+                user_bucket.tokens += 1
+                raise AdmissionRejected("⏳ This group is sending requests too quickly. Please wait a moment.")
+
+admission = AdmissionController()
+
+class DeadlineExceeded(AdmissionRejected):
+    """Raised when a request's deadline passes before it is scheduled"""
+
+class RequestScheduler:
+    """Weighted fair queue in front of the OpenAI backend
+    
+    At most `capacity` requests run at once, and at most `model_capacity`
+    for any one model. Waiting requests are served by priority class, then
+    by virtual finish time: each user's requests are spaced by cost /
+    weight on a shared virtual clock, so a burst from one user cannot
+    starve the others. Requests for a model at its cap wait without
+    holding up those for other models. Requests whose deadline passes
+    while queued are dropped with DeadlineExceeded.
+    """
+    
+    def __init__(self, capacity: int = OPENAI_MAX_CONCURRENCY, model_capacity: int = MODEL_MAX_CONCURRENCY):
+        self.capacity = capacity
+        self.model_capacity = model_capacity
+        self.running = 0
+        self.model_running: Dict[str, int] = {}
+        self.queue = []
+        self.virtual_time = 0.0
+        self.user_finish: Dict[int, float] = {}
+        self.sequence = itertools.count()
+    
+    def __len__(self) -> int:
+        return len(self.queue)
+    
+    def _has_room(self, model: str) -> bool:
+        return self.running < self.capacity and self.model_running.get(model, 0) < self.model_capacity
+    
+    def _start(self, model: str):
+        self.running += 1
+        self.model_running[model] = self.model_running.get(model, 0) + 1
+    
+    def _dispatch(self):
+        now = time.monotonic()
+        blocked = []
+        while self.running < self.capacity and self.queue:
+            entry = heapq.heappop(self.queue)
+            _, finish, _, future, deadline, model = entry
+            if future.done():
+                continue
+            if deadline is not None and deadline <= now:
+                future.set_exception(DeadlineExceeded("⌛ Your request expired while waiting. Please try again."))
+                continue
+            if not self._has_room(model):
+                blocked.append(entry)
+                continue
+            self.virtual_time = max(self.virtual_time, finish)
+            self._start(model)
+            future.set_result(None)
+        for entry in blocked:
+            heapq.heappush(self.queue, entry)
+        
+        # Users whose last request is behind the clock no longer affect ordering
+        if len(self.user_finish) > 10000:
+            self.user_finish = {
+                user: finish for user, finish in self.user_finish.items()
+                if finish > self.virtual_time
+            }
+    
+    def _release(self, model: str):
+        self.running -= 1
+        self.model_running[model] -= 1
+        if not self.model_running[model]:
+            del self.model_running[model]
+        self._dispatch()
+    
+    async def _wait(self, user_id: Optional[int], model: str, priority: int, deadline: Optional[float],
+                    cost: float, weight: float):
+        finish = max(self.virtual_time, self.user_finish.get(user_id, 0.0)) + cost / weight
+        self.user_finish[user_id] = finish
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, (priority, finish, next(self.sequence), future, deadline, model))
+        # Other models may have room while this one is at its cap
+        self._dispatch()
+        
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # Granted just as we gave up; hand the slot on
+                self._release(model)
+            else:
+                future.cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                raise DeadlineExceeded("⌛ Your request expired while waiting. Please try again.")
+            raise
+    
+    @asynccontextmanager
+    async def slot(self, user_id: Optional[int], model: str, priority: int = PRIORITY_NORMAL,
+                   deadline: Optional[float] = None, cost: float = 1.0, weight: float = 1.0):
+        """Wait for a turn to call a model and hold it"""
+        if not self.queue and self._has_room(model):
+            self._start(model)
+        else:
+            await self._wait(user_id, model, priority, deadline, cost, weight)
+        
+        try:
+            yield
+        finally:
+            self._release(model)
+
+scheduler = RequestScheduler()
+
+Gauge('bot_scheduler_queue_depth', 'Requests waiting for an OpenAI slot', lambda: len(scheduler))
+Gauge('bot_scheduler_running', 'OpenAI requests in flight', lambda: scheduler.running)
+Gauge('bot_usage_buffer_pending', 'Usage updates waiting to be written', lambda: bot_data.pending_usage if bot_data else 0)
+
+class BackendUnavailable(AdmissionRejected):
+    """Raised when every candidate model's circuit is open"""
+
+class PromptTooLong(AdmissionRejected):
+    """Raised when a prompt leaves no room for an answer"""
+
+class QuotaExceeded(AdmissionRejected):
+    """Raised when a user has spent their daily token quota"""
+
+async def budget_tokens(messages: list, model: str, user_id: Optional[int], max_tokens: int) -> tuple:
+    """Measure a prompt and clamp max_tokens before it is sent
+    
+    The answer is limited to what is left of the model's context window
+    and of the user's daily quota. Returns (prompt tokens, max_tokens).
+    """
+    await prime_token_counts([message['content'] for message in messages], model)
+    prompt = prompt_tokens(messages, model)
+    max_tokens = min(max_tokens, MODEL_CONTEXT_WINDOWS.get(model, 8192) - prompt)
+    if max_tokens < MIN_COMPLETION_TOKENS:
+        raise PromptTooLong(
+            f"📏 Your message is too long for `{model}` ({prompt:,} tokens). "
+            f"Please shorten it or use /reset."
+        )
+    
+    if (USER_DAILY_TOKEN_QUOTA and user_id is not None and not is_owner(user_id) and
+            not bot_data.has_user_api_key(user_id)):
+        remaining = USER_DAILY_TOKEN_QUOTA - await bot_data.get_tokens_today(user_id) - prompt
+        if remaining < MIN_COMPLETION_TOKENS:
+            raise QuotaExceeded(
+                f"📊 You've used your daily quota of {USER_DAILY_TOKEN_QUOTA:,} tokens. "
+                f"It resets at midnight UTC, or set your own key with /setapikey."
+            )
+        max_tokens = min(max_tokens, remaining)
+    return prompt, max_tokens
+
+class CircuitBreaker:
+    """Stops calling a model after sustained failures
+    
+    The circuit opens after BREAKER_FAILURE_THRESHOLD consecutive
+    failures. Once BREAKER_RESET_TIMEOUT has passed a single probe request
+    is let through; its outcome closes the circuit or opens it again.
+    """
+    
+    def __init__(self, name: str, threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probe_started: Optional[float] = None
+    
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+    
+    def allow(self) -> bool:
+        """Whether a request may be sent to the model"""
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < self.reset_timeout:
+            return False
+        # Half-open: one probe at a time; a probe that never reports back expires
+        if self.probe_started is not None and now - self.probe_started < self.reset_timeout:
+            return False
+        self.probe_started = now
+        return True
+    
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None
+    
+    def record_failure(self):
+        self.failures += 1
+        self.probe_started = None
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.warning(f"Circuit for {self.name} opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+# Breakers by (model, owner of the API key); None is the bot's own key
+circuit_breakers: Dict[tuple, CircuitBreaker] = {}
+
+class ModelStats:
+    """Rolling latency and error statistics of a model
+    
+    Only outcomes from the last ROUTING_WINDOW seconds count, so a model
+    that stopped receiving traffic because it was degraded is considered
+    healthy again once its bad samples age out.
+    """
+    
+    def __init__(self, window: float = ROUTING_WINDOW):
+        self.window = window
+        self.samples = deque(maxlen=1000)
+    
+    def _prune(self):
+        cutoff = time.monotonic() - self.window
+        while self.samples and self.samples[0][0] < cutoff:
+            self.samples.popleft()
+    
+    def record(self, latency: float, ok: bool):
+        """Record the outcome of a request"""
+        self.samples.append((time.monotonic(), latency, ok))
+    
+    def p95_latency(self) -> Optional[float]:
+        """95th percentile latency of successful requests"""
+        self._prune()
+        latencies = sorted(latency for _, latency, ok in self.samples if ok)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    
+    def error_rate(self) -> float:
+        """Share of failed requests"""
+        self._prune()
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, _, ok in self.samples if not ok) / len(self.samples)
+    
+    def is_degraded(self) -> bool:
+        """Whether latency or errors are past the routing thresholds"""
+        self._prune()
+        if len(self.samples) < ROUTING_MIN_SAMPLES:
+            return False
+        p95 = self.p95_latency()
+        return (
+            (p95 is not None and p95 > ROUTING_P95_LATENCY) or
+            self.error_rate() > ROUTING_ERROR_RATE
+        )
+
+# Statistics by (model, owner of the API key), like circuit_breakers
+model_stats: Dict[tuple, ModelStats] = {}
+
+def get_model_stats(model: str, key_owner: Optional[int] = None) -> ModelStats:
+    """Get the rolling statistics of a model on an API key"""
+    stats = model_stats.get((model, key_owner))
+    if stats is None:
+        stats = model_stats[(model, key_owner)] = ModelStats()
+    return stats
+
+def route_model(model: str, key_owner: Optional[int] = None) -> str:
+    """Pick the first healthy model along the preferred model's fallbacks"""
+    for candidate in fallback_chain(model):
+        if not get_model_stats(candidate, key_owner).is_degraded():
+            return candidate
+    return model
+
+def get_circuit_breaker(model: str, key_owner: Optional[int] = None) -> CircuitBreaker:
+    """Get the circuit breaker of a model on an API key
+    
+    Personal keys get breakers of their own, so one user's rate-limited
+    key does not cut everyone else off from the model.
+    """
+    breaker = circuit_breakers.get((model, key_owner))
+    if breaker is None:
+        name = model if key_owner is None else f"{model} (key of user {key_owner})"
+        breaker = circuit_breakers[(model, key_owner)] = CircuitBreaker(name)
+    return breaker
+
+def is_retryable_error(error: Exception) -> bool:
+    """Whether an OpenAI error is transient"""
+    if isinstance(error, openai.RateLimitError):
+        # An exhausted quota will not recover by retrying
+        return getattr(error, 'code', None) != 'insufficient_quota'
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409) or error.status_code >= 500
+    return False
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    """Delay before the next attempt, honoring Retry-After"""
+    response = getattr(error, 'response', None)
+    if response is not None:
+        headers = response.headers
+        try:
+            if headers.get('retry-after-ms'):
+                return min(float(headers['retry-after-ms']) / 1000, OPENAI_RETRY_MAX_DELAY)
+            if headers.get('retry-after'):
+                return min(float(headers['retry-after']), OPENAI_RETRY_MAX_DELAY)
+        except ValueError:
+            pass
+    # Full jitter exponential backoff
+    return random.uniform(0, min(OPENAI_RETRY_MAX_DELAY, OPENAI_RETRY_BASE_DELAY * 2 ** attempt))
+
+class OpenAIClientPool:
+    """LRU cache of per-user AsyncOpenAI clients
+    
+    All clients share openai_http_client, so requests made with personal
+    API keys reuse pooled connections. Clients idle for longer than
+    OPENAI_CLIENT_IDLE_TTL are dropped.
+    """
+    
+    def __init__(self, max_size: int = OPENAI_CLIENT_CACHE_SIZE, idle_ttl: float = OPENAI_CLIENT_IDLE_TTL):
+        self.clients = TTLCache(max_size, idle_ttl, sliding=True)
+    
+    def get(self, user_id: int, api_key: str) -> AsyncOpenAI:
+        """Get the client for a user's API key"""
+        entry = self.clients.get(user_id)
+        if entry is not None and entry[0] == api_key:
+            return entry[1]
+        
+        client = AsyncOpenAI(
+            api_key=api_key,
+            http_client=openai_http_client,
+            timeout=OPENAI_TIMEOUT,
+            max_retries=0
+        )
+        self.clients.set(user_id, (api_key, client))
+        return client
+    
+    def invalidate(self, user_id: int):
+        """Drop a user's client after their API key changed"""
+        self.clients.pop(user_id)
+
+openai_clients = OpenAIClientPool()
+
+def api_key_owner(user_id: Optional[int]) -> Optional[int]:
+    """The user whose personal API key a request runs on, or None for the bot's key"""
+    return user_id if user_id and bot_data.has_user_api_key(user_id) else None
+
+def get_openai_client(user_id: Optional[int]) -> AsyncOpenAI:
+    """Get the client for a user's personal API key, or the default client"""
+    init_openai()
+    user_api_key = bot_data.get_user_api_key(user_id) if user_id else None
+    if user_api_key:
+        return openai_clients.get(user_id, user_api_key)
+    return openai_client
+
+def normalize_query(text: str) -> str:
+    """Normalize user text for cache lookups"""
+    return ' '.join(text.lower().split())
+
+def embed_text(text: str, dimensions: int = 1 << 18) -> Dict[int, float]:
+    """Local sparse embedding from hashed words and character trigrams"""
+    text = normalize_query(text)
+    features = text.split()
+    padded = f" {text} "
+    features += [padded[i:i + 3] for i in range(len(padded) - 2)]
+    
+    vector = {}
+    for feature in features:
+        index = zlib.crc32(feature.encode()) % dimensions
+        vector[index] = vector.get(index, 0.0) + 1.0
+    norm = math.sqrt(sum(v * v for v in vector.values())) or 1.0
+    return {index: v / norm for index, v in vector.items()}
+
+# MinHash bands of similarity_buckets: texts sharing a fraction J of their
+# features share a bucket with probability 1 - (1 - J^rows)^bands
+LSH_BANDS = 8
+LSH_ROWS = 2
+LSH_PRIME = (1 << 61) - 1
+LSH_HASHES = [
+    (random.Random(seed).randrange(1, LSH_PRIME), random.Random(-seed).randrange(LSH_PRIME))
+    for seed in range(LSH_BANDS * LSH_ROWS)
+]
+
+def similarity_buckets(vector: Dict[int, float]) -> List[tuple]:
+    """Locality-sensitive bucket keys of a sparse vector's features"""
+    features = list(vector)
+    buckets = []
+    for band in range(LSH_BANDS):
+        signature = [band]
+        for a, b in LSH_HASHES[band * LSH_ROWS:(band + 1) * LSH_ROWS]:
+            signature.append(min((a * feature + b) % LSH_PRIME for feature in features))
+        buckets.append(tuple(signature))
+    return buckets
+
+def cosine_similarity(a: Dict[int, float], b: Dict[int, float]) -> float:
+    """Cosine similarity of two normalized sparse vectors"""
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(index, 0.0) for index, v in a.items())
+
+RESPONSE_CACHE_HITS = Counter('bot_response_cache_hits_total', 'Exact response cache hits')
+RESPONSE_CACHE_SIMILAR_HITS = Counter('bot_response_cache_similar_hits_total', 'Near-duplicate response cache hits')
+RESPONSE_CACHE_MISSES = Counter('bot_response_cache_misses_total', 'Response cache misses')
+
+class ResponseCache:
+    """Cache of single-turn completions
+    
+    Prompts are matched exactly by hashing (model, system prompt,
+    normalized user text). If similarity is set, an exact miss falls back
+    to the closest cached prompt with the same model and system prompt.
+    Only prompts sharing a similarity bucket with it are compared, so a
+    miss costs a few index lookups rather than a scan of the cache.
+    """
+    
+    def __init__(self, max_size: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL,
+                 similarity: float = RESPONSE_CACHE_SIMILARITY):
+        self.entries = TTLCache(max_size, ttl)
+        self.similarity = similarity
+        # (scope, bucket) -> keys of entries in it; evicted keys are dropped lazily
+        self.index: Dict[tuple, set] = {}
+        self.indexed = 0
+    
+    @staticmethod
+    def is_cacheable(messages: list) -> bool:
+        """Only a system prompt plus one user message is cached"""
+        return (
+            len(messages) == 2 and
+            messages[0]['role'] == 'system' and
+            messages[1]['role'] == 'user'
+        )
+    
+    @staticmethod
+    def _scope(model: str, messages: list) -> str:
+        return hashlib.sha256(f"{model}\0{messages[0]['content']}".encode()).hexdigest()
+    
+    def _key(self, model: str, messages: list) -> str:
+        text = normalize_query(messages[1]['content'])
+        return hashlib.sha256(f"{self._scope(model, messages)}\0{text}".encode()).hexdigest()
+    
+    def get(self, model: str, messages: list) -> Optional[tuple]:
+        """Look up a cached response as (content, model that answered)"""
+        entry = self.entries.get(self._key(model, messages))
+        if entry is not None:
+            RESPONSE_CACHE_HITS.inc()
+            return entry[3]
+        
+        if self.similarity > 0:
+            scope = self._scope(model, messages)
+            vector = embed_text(messages[1]['content'])
+            candidates = set()
+            for bucket in similarity_buckets(vector):
+                candidates.update(self.index.get((scope, bucket), ()))
+            best_key, best_score = None, self.similarity
+            for key in candidates:
+                stored = self.entries.entries.get(key)
+                if stored is None:
+                    continue
+                score = cosine_similarity(vector, stored[1][1])
+                if score >= best_score:
+                    best_key, best_score = key, score
+            if best_key is not None:
+                entry = self.entries.get(best_key)
+                if entry is not None:
+                    RESPONSE_CACHE_SIMILAR_HITS.inc()
+                    return entry[3]
+        
+        RESPONSE_CACHE_MISSES.inc()
+        return None
+    
+    def set(self, model: str, messages: list, content: str, used_model: Optional[str] = None):
+        """Store a response to a request for model, answered by used_model"""
+        key, scope = self._key(model, messages), self._scope(model, messages)
+        answer = (content, used_model or model)
+        if self.similarity <= 0:
+            self.entries.set(key, (scope, None, (), answer))
+            return
+        
+        vector = embed_text(messages[1]['content'])
+        buckets = similarity_buckets(vector)
+        self.entries.set(key, (scope, vector, buckets, answer))
+        for bucket in buckets:
+            self.index.setdefault((scope, bucket), set()).add(key)
+        self.indexed += 1
+        if self.indexed > 2 * self.entries.max_size:
+            self._rebuild_index()
+    
+    def _rebuild_index(self):
+        """Drop the keys of evicted and expired entries from the index"""
+        self.index = {}
+        for key, (_, (scope, _, buckets, _)) in self.entries.entries.items():
+            for bucket in buckets:
+                self.index.setdefault((scope, bucket), set()).add(key)
+        self.indexed = len(self.entries)
+
+response_cache = ResponseCache() if RESPONSE_CACHE else None
+
+class Completion(NamedTuple):
+    """Result of a chat completion"""
+    content: str
+    tokens: int
+    model: str
+    # 'api' when the completion was billed, 'cache' when served from cache,
+    # 'coalesced' when shared with an identical request in flight
+    source: str = 'api'
+
+class Flight:
+    """A completion in progress that identical requests can wait for
+    
+    Streamed deltas are forwarded to the leader and every follower; a
+    follower joining late first receives the text streamed so far.
+    """
+    
+    def __init__(self, on_delta=None):
+        self.future = asyncio.get_running_loop().create_future()
+        self.parts = []
+        self.listeners = [on_delta] if on_delta else []
+        self.followers = 0
+    
+    async def publish(self, delta: str):
+        """Forward a streamed delta to everyone waiting"""
+        self.parts.append(delta)
+        for listener in list(self.listeners):
+            try:
+                await listener(delta)
+            except Exception as e:
+                logger.warning(f"Stream update failed: {e}")
+    
+    def follow(self):
+        """Register a follower; before any await, so a failure reaches it"""
+        self.followers += 1
+    
+    async def join(self, on_delta, deadline: float) -> Completion:
+        """Wait for the leader's completion as a registered follower"""
+        if on_delta is not None:
+            self.listeners.append(on_delta)
+            if self.parts:
+                await on_delta(''.join(self.parts))
+        try:
+            completion = await asyncio.wait_for(
+                asyncio.shield(self.future), max(0.0, deadline - time.monotonic())
+            )
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded("⌛ Your request expired while waiting. Please try again.")
+        finally:
+            if on_delta in self.listeners:
+                self.listeners.remove(on_delta)
+        return completion._replace(tokens=0, source='coalesced')
+    
+    def finish(self, completion: Completion):
+        self.future.set_result(completion)
+    
+    def fail(self, error: BaseException):
+        if not self.followers:
+            return
+        if not isinstance(error, Exception):
+            # The leader was cancelled; its followers are not
+            error = BackendUnavailable("🔌 The request was interrupted. Please try again.")
+        self.future.set_exception(error)
+        # Followers that already gave up must not leave it unretrieved
+        self.future.exception()
+
+# Completions in progress, keyed by flight_key
+in_flight: Dict[str, Flight] = {}
+
+def flight_key(messages: list, model: str, user_id: Optional[int], max_tokens: int) -> str:
+    """Identity of a request for coalescing
+    
+    Requests billed to a user's own API key are only coalesced with that
+    user's requests.
+    """
+    billed_to = user_id if user_id is not None and bot_data.has_user_api_key(user_id) else None
+    payload = json.dumps([model, max_tokens, billed_to, messages], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class StreamEditor:
+    """Coalesces streamed text into rate-limited message edits"""
+    
+    def __init__(self, message: Message, interval: float = STREAM_EDIT_INTERVAL,
+                 min_chars: int = STREAM_EDIT_MIN_CHARS):
+        self.message = message
+        self.interval = interval
+        self.min_chars = min_chars
+        self.parts = []
+        self.length = 0
+        self.edited_length = 0
+        self.next_edit = 0.0
+    
+    @classmethod
+    def for_chat(cls, message: Message) -> "StreamEditor":
+        """Create an editor using the edit budget of the message's chat"""
+        if message.chat.type == enums.ChatType.PRIVATE:
+            return cls(message)
+        return cls(message, interval=STREAM_EDIT_INTERVAL_GROUP)
+    
+    @property
+    def text(self) -> str:
+        """Text received so far"""
+        return ''.join(self.parts)
+    
+    async def push(self, delta: str):
+        """Append a streamed delta and edit the message if the budget allows"""
+        self.parts.append(delta)
+        self.length += len(delta)
+        
+        now = time.monotonic()
+        if now < self.next_edit or self.length - self.edited_length < self.min_chars:
+            return
+        # Previews stop once the text outgrows a single message
+        if self.length > TELEGRAM_MESSAGE_LIMIT - 2:
+            return
+        
+        try:
+            await self.message.edit_text(self.text + " ▌")
+            self.edited_length = self.length
+            self.next_edit = now + self.interval
+        except FloodWait as e:
+            self.next_edit = now + e.value
+        except MessageNotModified:
+            self.next_edit = now + self.interval
+        except Exception as e:
+            logger.warning(f"Stream edit failed: {e}")
+            self.next_edit = now + self.interval
+
+CODE_FENCE = '```'
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    """Split text into messages of at most limit characters
+    
+    Cuts fall on paragraph, line or word boundaries where possible. A code
+    block that is cut is closed at the end of one message and reopened,
+    with its language, at the start of the next.
+    """
+    chunks = []
+    while len(text) > limit:
+        # Leave room to close a code block
+        window = text[:limit - len(CODE_FENCE) - 1]
+        for separator in ('\n\n', '\n', ' '):
+            cut = window.rfind(separator)
+            if cut > len(window) // 2:
+                chunk, text = window[:cut], text[cut + len(separator):]
+                break
+        else:
+            chunk, text = window, text[len(window):]
+        
+        fence = None
+        for line in chunk.split('\n'):
+            if line.lstrip().startswith(CODE_FENCE):
+                fence = None if fence else line.strip()
+        if fence:
+            chunk += '\n' + CODE_FENCE
+            text = fence + '\n' + text
+        chunks.append(chunk)
+    if text:
+        chunks.append(text)
+    return chunks
+
+async def _send_chunk(send, text: str) -> Message:
+    """Send one message, waiting out flood limits"""
+    while True:
+        try:
+            return await send(text)
+        except FloodWait as e:
+            await asyncio.sleep(e.value)
 
-def is_owner(user_id: int) -> bool:
-    """Check if user is the owner"""
-    return user_id == OWNER_ID
+async def deliver_response(message: Message, text: str, placeholder: Optional[Message] = None):
+    """Deliver a response of any length in reply to message
+    
+    The first part replaces the placeholder, if there is one, and the rest
+    follow as replies. Answers needing more than LONG_RESPONSE_MAX_MESSAGES
+    messages are attached as a Markdown file instead.
+    """
+    # Splitting is cheaper than pickling the text for a worker process
+    chunks = split_message(text)
+    
+    if LONG_RESPONSE_MAX_MESSAGES and len(chunks) > LONG_RESPONSE_MAX_MESSAGES:
+        document = io.BytesIO(text.encode())
+        document.name = "answer.md"
+        notice = "📄 The answer is too long for a message, so it is attached as a file."
+        await _send_chunk(placeholder.edit_text if placeholder else message.reply_text, notice)
+        await message.reply_document(document)
+        return
+    
+    await _send_chunk(placeholder.edit_text if placeholder else message.reply_text, chunks[0])
+    for chunk in chunks[1:]:
+        await _send_chunk(message.reply_text, chunk)
 
-def create_model_keyboard() -> InlineKeyboardMarkup:
-    """Create inline keyboard for model selection"""
-    buttons = []
-    for model_id, model_name in AVAILABLE_MODELS.items():
-        buttons.append([InlineKeyboardButton(
-            model_name,
-            callback_data=f"model_{model_id}"
-        )])
-    return InlineKeyboardMarkup(buttons)
+async def _stream_completion(client: AsyncOpenAI, messages: list, model: str,
+                             max_tokens: int, on_delta) -> tuple:
+    """Consume a streamed completion, forwarding deltas as they arrive"""
+    started = time.monotonic()
+    stream = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        max_tokens=max_tokens,
+        temperature=0.7,
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+    
+    parts = []
+    tokens = 0
+    async for chunk in stream:
+        if chunk.usage:
+            tokens = chunk.usage.total_tokens
+        if chunk.choices:
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if not parts:
+                    OPENAI_TTFT.observe(time.monotonic() - started, model=model)
+                parts.append(delta)
+                await on_delta(delta)
+    
+    return ''.join(parts), tokens
 
-def create_main_menu() -> InlineKeyboardMarkup:
-    """Create main menu keyboard"""
-    buttons = [
-        [InlineKeyboardButton("🤖 Change Model", callback_data="change_model")],
-        [InlineKeyboardButton("📊 Usage Stats", callback_data="stats")],
-        [InlineKeyboardButton("ℹ️ Help", callback_data="help")]
-    ]
-    return InlineKeyboardMarkup(buttons)
+async def call_openai_api(messages: list, model: str, user_id: int = None, max_tokens: int = 2000,
+                          on_delta=None, priority: int = PRIORITY_NORMAL,
+                          deadline: Optional[float] = None) -> Completion:
+    """Call OpenAI API and return the completion
+    
+    If on_delta is given, the completion is streamed and on_delta is
+    awaited with every text delta as it arrives. Single-turn prompts are
+    answered from response_cache when enabled; cache hits cost no tokens.
+    Backend calls go through the scheduler; deadline is a time.monotonic()
+    value after which a still-queued request is dropped. Transient errors
+    are retried, and with MODEL_FALLBACK a failing model falls back to a
+    cheaper one. With ROUTING_ENABLED a model whose recent latency or
+    error rate is past the thresholds is skipped up front.
+    With COALESCE_REQUESTS, a request identical to one already in flight
+    waits for that one's answer instead of calling the backend again; it is
+    returned with source 'coalesced' and 0 tokens, so it is billed once,
+    but only if its user still has room in their daily quota.
+    Prompts are measured first: max_tokens is clamped to the context
+    window and the user's daily quota, and prompts that leave no room for
+    an answer are rejected without a round trip.
+    Completion.model is the model that answered.
+    """
+    cacheable = response_cache is not None and ResponseCache.is_cacheable(messages)
+    if cacheable:
+        cached = response_cache.get(model, messages)
+        if cached is not None:
+            content, used_model = cached
+            return Completion(content, 0, used_model, 'cache')
+    
+    if user_id is not None and is_owner(user_id):
+        priority = PRIORITY_OWNER
+    if deadline is None:
+        deadline = time.monotonic() + REQUEST_DEADLINE
+    
+    if not COALESCE_REQUESTS:
+        return await _call_backend(messages, model, user_id, max_tokens, on_delta, priority, deadline, cacheable)
+    
+    key = flight_key(messages, model, user_id, max_tokens)
+    flight = in_flight.get(key)
+    if flight is not None:
+        flight.follow()
+        # Shared answers cost nothing, but a user past their quota gets none
+        await budget_tokens(messages, model, user_id, max_tokens)
+        return await flight.join(on_delta, deadline)
+    
+    flight = in_flight[key] = Flight(on_delta)
+    try:
+        completion = await _call_backend(
+            messages, model, user_id, max_tokens,
+            flight.publish if on_delta else None, priority, deadline, cacheable
+        )
+    except BaseException as e:
+        flight.fail(e)
+        raise
+    finally:
+        del in_flight[key]
+    flight.finish(completion)
+    return completion
+
+async def _call_backend(messages: list, model: str, user_id: Optional[int], max_tokens: int,
+                        on_delta, priority: int, deadline: float, cacheable: bool) -> Completion:
+    """Budget, route and run a completion, then cache its answer"""
+    routed_model = route_model(model, api_key_owner(user_id)) if ROUTING_ENABLED else model
+    if routed_model != model:
+        logger.info(f"Routing {model} request to {routed_model}")
+    
+    prompt, max_tokens = await budget_tokens(messages, routed_model, user_id, max_tokens)
+    logger.debug(
+        f"Prompt of {prompt} tokens for {routed_model}, "
+        f"at most ${estimate_cost(routed_model, prompt, max_tokens):.4f}"
+    )
+    
+    content, tokens, used_model = await _complete_with_retries(
+        messages, routed_model, user_id, max_tokens, on_delta, priority, deadline
+    )
+    OPENAI_COST.inc(estimate_cost(used_model, prompt, max(0, tokens - prompt)), model=used_model)
+    
+    if cacheable and content:
+        response_cache.set(model, messages, content, used_model)
+    return Completion(content, tokens, used_model)
+
+async def _complete_with_retries(messages: list, model: str, user_id: Optional[int], max_tokens: int,
+                                 on_delta, priority: int, deadline: float) -> tuple:
+    """Run a completion with retries, circuit breakers and model fallback"""
+    streamed = False
+    
+    async def forward(delta: str):
+        nonlocal streamed
+        streamed = True
+        await on_delta(delta)
+    
+    candidates = fallback_chain(model) if MODEL_FALLBACK else [model]
+    error: Exception = BackendUnavailable(
+        f"🔌 `{model}` is temporarily unavailable. Please try again shortly."
+    )
+    
+    key_owner = api_key_owner(user_id)
+    for candidate in candidates:
+        breaker = get_circuit_breaker(candidate, key_owner)
+        stats = get_model_stats(candidate, key_owner)
+        if not breaker.allow():
+            continue
+        
+        candidate_max_tokens = max_tokens
+        if candidate != model:
+            # A fallback may have a smaller context window than the model budgeted for
+            try:
+                _, candidate_max_tokens = await budget_tokens(messages, candidate, user_id, max_tokens)
+            except PromptTooLong:
+                logger.info(f"Skipping fallback {candidate}: prompt does not fit its context window")
+                continue
+        
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            try:
+                async with scheduler.slot(user_id, candidate, priority, deadline):
+                    started = time.monotonic()
+                    content, tokens = await _request_completion(
+                        messages, candidate, user_id, candidate_max_tokens,
+                        forward if on_delta else None
+                    )
+            except Exception as e:
+                if not is_retryable_error(e):
+                    raise
+                breaker.record_failure()
+                stats.record(time.monotonic() - started, False)
+                OPENAI_LATENCY.observe(time.monotonic() - started, model=candidate, outcome='error')
+                error = e
+                # Part of the answer is already on screen; a retry would repeat it
+                if streamed:
+                    raise
+                delay = retry_delay(e, attempt)
+                if (attempt == OPENAI_MAX_RETRIES or not breaker.allow() or
+                        time.monotonic() + delay > deadline):
+                    break
+                logger.warning(
+                    f"OpenAI {candidate} failed ({e}); retrying in {delay:.1f}s",
+                    extra={'user_id': user_id, 'model': candidate, 'attempt': attempt + 1}
+                )
+                await asyncio.sleep(delay)
+            else:
+                latency = time.monotonic() - started
+                breaker.record_success()
+                stats.record(latency, True)
+                OPENAI_LATENCY.observe(latency, model=candidate, outcome='ok')
+                OPENAI_TOKENS.inc(tokens, model=candidate)
+                logger.info(
+                    f"{candidate} answered in {latency:.2f}s ({tokens} tokens)",
+                    extra={'user_id': user_id, 'model': candidate, 'latency': round(latency, 3), 'tokens': tokens}
+                )
+                if candidate != model:
+                    logger.warning(f"Fell back from {model} to {candidate}")
+                return content, tokens, candidate
+    
+    raise error
 
-async def call_openai_api(messages: list, model: str, user_id: int = None, max_tokens: int = 2000) -> tuple:
-    """Call OpenAI API and return response with token count"""
+async def _request_completion(messages: list, model: str, user_id: Optional[int],
+                              max_tokens: int, on_delta) -> tuple:
+    """Send a completion request and return response with token count"""
     try:
-        user_api_key = bot_data.get_user_api_key(user_id) if user_id else None
+        client = get_openai_client(user_id)
         
-        if user_api_key:
-            client = OpenAI(api_key=user_api_key)
-        else:
-            client = openai_client
+        if on_delta is not None:
+            return await _stream_completion(client, messages, model, max_tokens, on_delta)
         
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model=model,
             messages=messages,
             max_tokens=max_tokens,
@@ -247,15 +2791,34 @@ async def call_openai_api(messages: list, model: str, user_id: int = None, max_t
         
         return content, tokens
     except Exception as e:
-        logger.error(f"OpenAI API error: {e}")
+        logger.error(f"OpenAI API error: {e}", extra={'user_id': user_id, 'model': model})
         raise
 
+async def claim_update(client: Client, update):
+    """Let only one of the workers sharing state handle each update
+    
+    Registered ahead of all other handlers by load_state() when state is
+    shared.
+    """
+    if isinstance(update, Message):
+        name = f"update:message:{update.chat.id}:{update.id}"
+    else:
+        name = f"update:{type(update).__name__}:{update.id}"
+    try:
+        claimed = await bot_data.storage.claim(name)
+    except Exception as e:
+        # Handling an update twice beats dropping it
+        logger.warning(f"Update claim failed: {e}")
+        claimed = True
+    if not claimed:
+        update.stop_propagation()
+
 @app.on_message(filters.command("start"))
 async def start_command(client: Client, message: Message):
     """Handle /start command"""
     user = message.from_user
     
-    if not bot_data.is_user_authorized(user.id):
+    if not bot_data.check_access(user.id):
         await message.reply_text(
             "❌ **Access Denied**\n\n"
             "You are not authorized to use this bot.\n"
@@ -263,34 +2826,17 @@ async def start_command(client: Client, message: Message):
         )
         return
     
-    welcome_text = f"""
-🤖 **Welcome to Advanced AI Assistant Bot!**
-
-Hello {user.mention}! I'm powered by OpenAI's latest models.
-
-**Features:**
-• 💬 Chat with AI in private or groups
-• 🔍 Inline mode for quick queries
-• 🤖 Multiple AI models to choose from
-• 📊 Track your usage statistics
-
-**Quick Start:**
-• Use /ask <question> to ask me anything
-• Use /model to change AI model
-• Type @{(await client.get_me()).username} <query> in any chat for inline mode
-
-Ready to assist you! 🚀
-    """
+    welcome_text = ui.welcome_text(await ui.bot_username(client), user.mention)
     
     await message.reply_text(
         welcome_text,
-        reply_markup=create_main_menu()
+        reply_markup=ui.main_menu
     )
 
 @app.on_message(filters.command("model"))
 async def model_command(client: Client, message: Message):
     """Handle /model command"""
-    if not bot_data.is_user_authorized(message.from_user.id):
+    if not bot_data.check_access(message.from_user.id):
         await message.reply_text("❌ Unauthorized access.")
         return
     
@@ -302,24 +2848,23 @@ async def model_command(client: Client, message: Message):
     
     await message.reply_text(
         text,
-        reply_markup=create_model_keyboard()
+        reply_markup=ui.model_keyboard()
     )
 
 @app.on_message(filters.command("ask"))
+@instrumented
 async def ask_command(client: Client, message: Message):
     """Handle /ask command"""
     user_id = message.from_user.id
     
-    # Check authorization for private chats
-    if message.chat.type == enums.ChatType.PRIVATE:
-        if not bot_data.is_user_authorized(user_id):
+    # Private chats check the user, groups check the group
+    is_private = message.chat.type == enums.ChatType.PRIVATE
+    if not bot_data.check_access(user_id, None if is_private else message.chat.id):
+        if is_private:
             await message.reply_text("❌ You are not authorized to use this bot.")
-            return
-    else:
-        # Check group authorization
-        if not bot_data.is_group_authorized(message.chat.id):
+        else:
             await message.reply_text("❌ This group is not authorized to use this bot.")
-            return
+        return
     
     # Extract question
     question = message.text.split(maxsplit=1)
@@ -327,7 +2872,14 @@ async def ask_command(client: Client, message: Message):
         await message.reply_text("❓ Please provide a question.\n\nUsage: `/ask your question here`")
         return
     
-    question_text = question[1]
+    # The answer can take minutes; the update worker is not kept waiting
+    spawn(answer_question(client, message, question[1]))
+
+@instrumented
+async def answer_question(client: Client, message: Message, question_text: str):
+    """Answer an /ask question"""
+    user_id = message.from_user.id
+    is_private = message.chat.type == enums.ChatType.PRIVATE
     
     # Get user's model preference
     model = bot_data.get_user_model(user_id)
@@ -345,21 +2897,38 @@ async def ask_command(client: Client, message: Message):
             {"role": "user", "content": question_text}
         ]
         
-        response, tokens = await call_openai_api(messages, model, user_id)
+        editor = StreamEditor.for_chat(processing_msg) if STREAM_RESPONSES else None
+        admission.check_rate(user_id, None if is_private else message.chat.id)
+        result = await call_openai_api(
+            messages, model, user_id,
+            on_delta=editor.push if editor else None
+        )
         
         # Log usage
-        bot_data.log_usage(user_id, model, tokens)
+        bot_data.log_usage(user_id, result.model, result.tokens, result.source)
         
         # Format response
-        response_text = f"{response}\n\n"
+        response_text = f"{result.content}\n\n"
         response_text += f"━━━━━━━━━━━━━━━\n"
-        response_text += f"🤖 Model: `{model}`\n"
-        response_text += f"🎯 Tokens: `{tokens}`"
+        response_text += f"🤖 Model: `{result.model}`"
+        if result.model != model:
+            response_text += f" (instead of `{model}`)"
+        response_text += "\n"
+        response_text += f"🎯 Tokens: `{result.tokens}`"
+        if result.source == 'cache':
+            response_text += " ♻️ cached"
+        elif result.source == 'coalesced':
+            response_text += " 🔗 shared"
         
-        await processing_msg.edit_text(response_text)
+        await deliver_response(message, response_text, processing_msg)
         
+    except AdmissionRejected as e:
+        await processing_msg.edit_text(str(e))
     except Exception as e:
-        logger.error(f"Error processing question: {e}")
+        logger.error(
+            f"Error processing question: {e}",
+            extra={'user_id': user_id, 'chat_id': message.chat.id, 'model': model}
+        )
         await processing_msg.edit_text(
             f"❌ **Error occurred:**\n`{str(e)}`\n\n"
             "Please try again later or contact support."
@@ -370,11 +2939,11 @@ async def stats_command(client: Client, message: Message):
     """Handle /stats command"""
     user_id = message.from_user.id
     
-    if not bot_data.is_user_authorized(user_id):
+    if not bot_data.check_access(user_id):
         await message.reply_text("❌ Unauthorized access.")
         return
     
-    stats = bot_data.data['usage_stats'].get(str(user_id))
+    stats = await bot_data.get_usage_stats(user_id)
     
     if not stats:
         await message.reply_text("📊 No usage statistics available yet.")
@@ -382,7 +2951,16 @@ async def stats_command(client: Client, message: Message):
     
     text = "📊 **Your Usage Statistics**\n\n"
     text += f"🔢 Total Requests: `{stats['total_requests']}`\n"
-    text += f"🎯 Total Tokens: `{stats['total_tokens']:,}`\n\n"
+    text += f"🎯 Total Tokens: `{stats['total_tokens']:,}`\n"
+    if stats.get('cache_hits'):
+        text += f"♻️ Cached Answers: `{stats['cache_hits']}`\n"
+    if stats.get('coalesced_hits'):
+        text += f"🔗 Shared Answers: `{stats['coalesced_hits']}`\n"
+    if stats.get('batch_hits'):
+        text += f"🗂 Batch Answers: `{stats['batch_hits']}`\n"
+    if USER_DAILY_TOKEN_QUOTA and not is_owner(user_id) and not bot_data.has_user_api_key(user_id):
+        text += f"📅 Today: `{await bot_data.get_tokens_today(user_id):,}` / `{USER_DAILY_TOKEN_QUOTA:,}` tokens\n"
+    text += "\n"
     text += "**By Model:**\n"
     
     for model, data in stats['by_model'].items():
@@ -393,49 +2971,14 @@ async def stats_command(client: Client, message: Message):
 @app.on_message(filters.command("help"))
 async def help_command(client: Client, message: Message):
     """Handle /help command"""
-    help_text = """
-📚 **Bot Commands & Features**
-
-**Basic Commands:**
-• `/start` - Start the bot and see main menu
-• `/ask <question>` - Ask AI a question
-• `/model` - Change AI model
-• `/stats` - View your usage statistics
-• `/help` - Show this help message
-
-**API Key Management:**
-• `/setapikey <key>` - Set your personal OpenAI API key
-• `/removeapikey` - Remove your API key
-• `/myapikey` - Check API key status
-
-**Inline Mode:**
-Type `@botusername your question` in any chat to get instant AI responses!
-
-**Owner Commands:**
-• `/auth <user_id>` - Authorize user
-• `/revoke <user_id>` - Revoke user access
-• `/authgroup` - Authorize current group
-• `/revokegroup` - Revoke group access
-• `/ban <user_id>` - Ban user
-• `/unban <user_id>` - Unban user
-• `/broadcast <message>` - Broadcast to all users
-
-**Available Models:**
-    """
-    
-    for model_id, model_name in AVAILABLE_MODELS.items():
-        help_text += f"• {model_name}\n"
-    
-    help_text += "\n🔥 Powered by OpenAI's cutting-edge AI technology!"
-    
-    await message.reply_text(help_text)
+    await message.reply_text(ui.help_text())
 
 @app.on_message(filters.command("setapikey"))
 async def setapikey_command(client: Client, message: Message):
     """Set personal OpenAI API key"""
     user_id = message.from_user.id
     
-    if not bot_data.is_user_authorized(user_id):
+    if not bot_data.check_access(user_id):
         await message.reply_text("❌ Unauthorized access.")
         return
     
@@ -484,7 +3027,7 @@ async def removeapikey_command(client: Client, message: Message):
     """Remove personal OpenAI API key"""
     user_id = message.from_user.id
     
-    if not bot_data.is_user_authorized(user_id):
+    if not bot_data.check_access(user_id):
         await message.reply_text("❌ Unauthorized access.")
         return
     
@@ -504,7 +3047,7 @@ async def myapikey_command(client: Client, message: Message):
     """Check API key status"""
     user_id = message.from_user.id
     
-    if not bot_data.is_user_authorized(user_id):
+    if not bot_data.check_access(user_id):
         await message.reply_text("❌ Unauthorized access.")
         return
     
@@ -523,6 +3066,16 @@ async def myapikey_command(client: Client, message: Message):
             "Use `/setapikey <your-key>` to set yours."
         )
 
+@app.on_message(filters.command("reset"))
+async def reset_command(client: Client, message: Message):
+    """Clear conversation history"""
+    if not bot_data.check_access(message.from_user.id):
+        await message.reply_text("❌ Unauthorized access.")
+        return
+    
+    conversations.clear(message.chat.id)
+    await message.reply_text("🧹 Conversation history cleared.")
+
 # Owner-only commands
 @app.on_message(filters.command("auth") & filters.user(OWNER_ID))
 async def auth_command(client: Client, message: Message):
@@ -584,6 +3137,133 @@ async def unban_command(client: Client, message: Message):
     except (IndexError, ValueError):
         await message.reply_text("Usage: `/unban <user_id>`")
 
+class Broadcast:
+    """Rate-limited, resumable delivery of a broadcast message
+    
+    Users are sent to by BROADCAST_CONCURRENCY workers sharing a token
+    bucket of BROADCAST_RATE messages per second. A FloodWait pauses all
+    workers before the message is retried. Progress is persisted as a
+    cursor below which every user has been handled, so a restarted bot
+    resumes from there (users past the cursor may receive it twice).
+    With shared state the delivering worker holds the 'broadcast' lease,
+    and stops delivering if it fails to renew it, since another worker
+    may have taken the broadcast over.
+    """
+    
+    def __init__(self, client: Client, state: dict):
+        self.client = client
+        self.state = state
+        self.users = state['users']
+        self.next_index = state['cursor']
+        self.done = set()
+        self.limiter = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+        self.lease_lost = False
+    
+    @classmethod
+    def create(cls, client: Client, text: str, status_msg: Message) -> "Broadcast":
+        """Start a new broadcast to all authorized users"""
+        state = {
+            'text': text,
+            'users': bot_data.get_authorized_users(),
+            'cursor': 0,
+            'success': 0,
+            'failed': 0,
+            'chat_id': status_msg.chat.id,
+            'message_id': status_msg.id
+        }
+        bot_data.save_broadcast(state)
+        return cls(client, state)
+    
+    def _complete(self, index: int, ok: bool):
+        self.state['success' if ok else 'failed'] += 1
+        self.done.add(index)
+        while self.state['cursor'] in self.done:
+            self.done.remove(self.state['cursor'])
+            self.state['cursor'] += 1
+    
+    async def _send(self, user_id: int) -> bool:
+        text = f"📢 **Broadcast Message**\n\n{self.state['text']}"
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            await self.limiter.acquire()
+            try:
+                await self.client.send_message(user_id, text)
+                return True
+            except FloodWait as e:
+                logger.warning(f"Broadcast FloodWait of {e.value}s (attempt {attempt + 1})")
+                self.limiter.pause(e.value)
+            except Exception as e:
+                logger.error(f"Failed to send to {user_id}: {e}")
+                return False
+        return False
+    
+    async def _worker(self):
+        while self.next_index < len(self.users):
+            index = self.next_index
+            self.next_index += 1
+            self._complete(index, await self._send(self.users[index]))
+    
+    async def _edit_status(self, text: str):
+        try:
+            await self.client.edit_message_text(self.state['chat_id'], self.state['message_id'], text)
+        except MessageNotModified:
+            pass
+        except Exception as e:
+            logger.warning(f"Broadcast status update failed: {e}")
+    
+    async def _report_progress(self, workers: asyncio.Future):
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            if not await bot_data.acquire_lease('broadcast', BROADCAST_LEASE_TTL):
+                logger.warning("Lost the broadcast lease; leaving the broadcast to the worker holding it")
+                self.lease_lost = True
+                workers.cancel()
+                return
+            bot_data.save_broadcast(self.state)
+            await self._edit_status(
+                f"📢 Broadcasting message...\n\n"
+                f"Progress: {self.state['cursor']}/{len(self.users)}\n"
+                f"Success: {self.state['success']}\n"
+                f"Failed: {self.state['failed']}"
+            )
+    
+    async def run(self):
+        """Deliver the broadcast and report the result"""
+        workers = asyncio.gather(*(self._worker() for _ in range(BROADCAST_CONCURRENCY)))
+        progress = asyncio.create_task(self._report_progress(workers))
+        try:
+            await workers
+        except asyncio.CancelledError:
+            if not self.lease_lost:
+                raise
+            return
+        finally:
+            progress.cancel()
+        
+        bot_data.clear_broadcast()
+        await bot_data.release_lease('broadcast')
+        await self._edit_status(
+            f"✅ Broadcast complete!\n\n"
+            f"Success: {self.state['success']}\n"
+            f"Failed: {self.state['failed']}"
+        )
+
+# The broadcast currently being delivered and its task
+active_broadcast: Optional[Broadcast] = None
+active_broadcast_task: Optional[asyncio.Task] = None
+
+def start_broadcast(broadcast: Broadcast):
+    """Run a broadcast in the background"""
+    global active_broadcast, active_broadcast_task
+    active_broadcast = broadcast
+    active_broadcast_task = asyncio.create_task(broadcast.run())
+
+async def stop_broadcast():
+    """Stop a running broadcast, keeping its cursor for the next start"""
+    if active_broadcast_task is not None and not active_broadcast_task.done():
+        active_broadcast_task.cancel()
+        bot_data.save_broadcast(active_broadcast.state)
+        await bot_data.release_lease('broadcast')
+
 @app.on_message(filters.command("broadcast") & filters.user(OWNER_ID))
 async def broadcast_command(client: Client, message: Message):
     """Broadcast message to all authorized users"""
@@ -592,35 +3272,306 @@ async def broadcast_command(client: Client, message: Message):
         await message.reply_text("Usage: `/broadcast <message>`")
         return
     
+    if (active_broadcast_task is not None and not active_broadcast_task.done()) or \
+            not await bot_data.acquire_lease('broadcast', BROADCAST_LEASE_TTL):
+        await message.reply_text("⏳ A broadcast is already in progress.")
+        return
+    
     broadcast_text = msg_text[1]
-    users = bot_data.data['authorized_users']
+    status_msg = await message.reply_text("📢 Broadcasting message...")
+    start_broadcast(Broadcast.create(client, broadcast_text, status_msg))
+
+@app.on_message(filters.command("batch"))
+@instrumented
+async def batch_command(client: Client, message: Message):
+    """Queue a question for the Batch API; the answer is sent when ready"""
+    user_id = message.from_user.id
     
-    success = 0
-    failed = 0
+    is_private = message.chat.type == enums.ChatType.PRIVATE
+    if not bot_data.check_access(user_id, None if is_private else message.chat.id):
+        if is_private:
+            await message.reply_text("❌ You are not authorized to use this bot.")
+        else:
+            await message.reply_text("❌ This group is not authorized to use this bot.")
+        return
     
-    status_msg = await message.reply_text("📢 Broadcasting message...")
+    question = message.text.split(maxsplit=1)
+    if len(question) < 2:
+        await message.reply_text(
+            "❓ Please provide a question.\n\nUsage: `/batch your question here`\n\n"
+            "Batch answers arrive within 24 hours, usually much sooner, and cost half as much."
+        )
+        return
+    
+    pending = bot_data.count_batch_requests(user_id)
+    if pending >= BATCH_MAX_PENDING_PER_USER and not is_owner(user_id):
+        await message.reply_text(f"⏳ You already have {pending} questions waiting for batch answers.")
+        return
+    
+    model = bot_data.get_user_model(user_id)
+    messages = [
+        {"role": "system", "content": "You are a helpful, intelligent AI assistant. Provide clear, accurate, and concise responses."},
+        {"role": "user", "content": question[1]}
+    ]
+    try:
+        _, max_tokens = await budget_tokens(messages, model, user_id, 2000)
+    except AdmissionRejected as e:
+        await message.reply_text(str(e))
+        return
+    
+    bot_data.queue_batch_request({
+        'custom_id': f"{message.chat.id}:{message.id}",
+        'chat_id': message.chat.id,
+        'message_id': message.id,
+        'user_id': user_id,
+        # Whose API key the job is billed to; None for the bot's own
+        'key_owner': user_id if bot_data.has_user_api_key(user_id) else None,
+        'model': model,
+        'messages': messages,
+        'max_tokens': max_tokens,
+        'queued': time.time()
+    })
+    await message.reply_text(
+        "🗂 **Queued for batch processing**\n\n"
+        "The answer will be sent here when it is ready, usually within minutes."
+    )
+
+async def send_batch_answer(request: dict, text: str):
+    """Send a batch answer in reply to the question it belongs to"""
+    chat_id, message_id = request['chat_id'], request['message_id']
+    try:
+        chunks = split_message(text)
+        if LONG_RESPONSE_MAX_MESSAGES and len(chunks) > LONG_RESPONSE_MAX_MESSAGES:
+            document = io.BytesIO(text.encode())
+            document.name = "answer.md"
+            await app.send_document(chat_id, document, reply_to_message_id=message_id)
+            return
+        send = functools.partial(app.send_message, chat_id, reply_to_message_id=message_id)
+        for chunk in chunks:
+            await _send_chunk(send, chunk)
+    except Exception as e:
+        logger.warning(
+            f"Batch answer for {request['custom_id']} not delivered: {e}",
+            extra={'user_id': request['user_id'], 'chat_id': chat_id}
+        )
+
+async def deliver_batch_result(request: dict, result: dict):
+    """Deliver one line of a batch output or error file"""
+    response = result.get('response') or {}
+    body = response.get('body') or {}
+    if response.get('status_code') != 200 or not body.get('choices'):
+        error = (result.get('error') or body.get('error') or {}).get('message', 'unknown error')
+        await send_batch_answer(request, f"❌ **Batch request failed:**\n`{error}`\n\nPlease try again with /ask.")
+        return
+    
+    model = request['model']
+    usage = body.get('usage') or {}
+    tokens = usage.get('total_tokens', 0)
+    bot_data.log_usage(request['user_id'], model, tokens, 'batch')
+    OPENAI_TOKENS.inc(tokens, model=model)
+    OPENAI_COST.inc(
+        estimate_cost(model, usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)) * BATCH_DISCOUNT,
+        model=model
+    )
+    
+    response_text = f"{body['choices'][0]['message']['content'] or ''}\n\n"
+    response_text += f"━━━━━━━━━━━━━━━\n"
+    response_text += f"🤖 Model: `{model}`\n"
+    response_text += f"🎯 Tokens: `{tokens}` 🗂 batch"
+    await send_batch_answer(request, response_text)
+
+async def fail_batch_requests(requests, reason: str):
+    """Tell the users behind requests that they will get no answer"""
+    for request in requests:
+        await send_batch_answer(request, f"❌ Your batch question was not answered ({reason}). Please try again with /ask.")
+
+def batch_key_id(key_owner: Optional[int]) -> Optional[str]:
+    """Identify the API key a user's batch jobs run on, without storing it"""
+    api_key = bot_data.get_user_api_key(key_owner) if key_owner is not None else None
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16] if api_key else None
+
+async def rebill_batch_request(request: dict) -> Optional[dict]:
+    """Move a queued prompt whose user removed their API key to the bot's key
+    
+    The prompt is budgeted again, daily quota included, since that was
+    skipped while it ran on the user's key. Prompts that no longer fit
+    are failed; returns the updated prompt otherwise.
+    """
+    try:
+        _, max_tokens = await budget_tokens(
+            request['messages'], request['model'], request['user_id'], request['max_tokens']
+        )
+    except AdmissionRejected as e:
+        await send_batch_answer(request, f"❌ Your API key was removed, so your batch question was not answered.\n\n{e}")
+        bot_data.dequeue_batch_request(request['custom_id'])
+        return None
+    request = dict(request, key_owner=None, max_tokens=max_tokens)
+    bot_data.queue_batch_request(request)
+    return request
+
+async def submit_batch_job(key_owner: Optional[int], requests: List[dict]):
+    """Upload prompts as a JSONL file and create a batch job for them"""
+    lines = [
+        json.dumps({
+            'custom_id': request['custom_id'],
+            'method': 'POST',
+            'url': BATCH_ENDPOINT,
+            'body': {
+                'model': request['model'],
+                'messages': request['messages'],
+                'max_tokens': request['max_tokens'],
+                'temperature': 0.7
+            }
+        })
+        for request in requests
+    ]
+    client = get_openai_client(key_owner)
+    input_file = await client.files.create(file=('batch.jsonl', '\n'.join(lines).encode()), purpose='batch')
+    batch = await client.batches.create(
+        input_file_id=input_file.id, endpoint=BATCH_ENDPOINT, completion_window='24h'
+    )
+    bot_data.save_batch_job({
+        'id': batch.id,
+        'key_owner': key_owner,
+        'key_id': batch_key_id(key_owner),
+        'status': batch.status,
+        'submitted': time.time(),
+        'requests': {
+            request['custom_id']: {
+                key: request[key] for key in ('custom_id', 'chat_id', 'message_id', 'user_id', 'model')
+            }
+            for request in requests
+        }
+    })
+    for request in requests:
+        bot_data.dequeue_batch_request(request['custom_id'])
+    logger.info(f"Submitted batch {batch.id} with {len(requests)} requests")
+
+async def submit_batch_jobs():
+    """Submit queued prompts as batch jobs once they are due
+    
+    Prompts are grouped by the API key they are billed to. A group is
+    submitted once its oldest prompt has waited BATCH_COLLECT_SECONDS or
+    it holds BATCH_MAX_REQUESTS prompts.
+    """
+    groups = {}
+    for request in bot_data.get_batch_queue():
+        if request['key_owner'] is not None and not bot_data.has_user_api_key(request['key_owner']):
+            request = await rebill_batch_request(request)
+            if request is None:
+                continue
+        groups.setdefault(request['key_owner'], []).append(request)
+    
+    now = time.time()
+    for key_owner, requests in groups.items():
+        while len(requests) >= BATCH_MAX_REQUESTS or (requests and now - requests[0]['queued'] >= BATCH_COLLECT_SECONDS):
+            chunk, requests = requests[:BATCH_MAX_REQUESTS], requests[BATCH_MAX_REQUESTS:]
+            try:
+                await submit_batch_job(key_owner, chunk)
+            except Exception as e:
+                if not isinstance(e, openai.APIStatusError) or is_retryable_error(e):
+                    raise
+                logger.error(f"Batch submission rejected: {e}", extra={'user_id': key_owner})
+                await fail_batch_requests(chunk, "the batch was rejected")
+                for request in chunk:
+                    bot_data.dequeue_batch_request(request['custom_id'])
+
+async def poll_batch_job(job: dict):
+    """Check a batch job and deliver its answers once it has ended
+    
+    Answers are delivered from the output file, failures from the error
+    file, and requests missing from both are reported as unanswered. The
+    job is forgotten afterwards, so answers delivered just before a
+    restart may be sent twice. Jobs whose API key was removed or replaced
+    are failed right away, since no other key can retrieve them.
+    """
+    if job['key_owner'] is not None:
+        key_id = batch_key_id(job['key_owner'])
+        # Jobs saved without a key id are only checked for a key being set
+        if key_id is None or key_id != job.get('key_id', key_id):
+            await fail_batch_requests(job['requests'].values(), "the API key it was billed to was removed or changed")
+            bot_data.delete_batch_job(job['id'])
+            logger.info(f"Batch {job['id']} dropped: its API key was removed or changed", extra={'user_id': job['key_owner']})
+            return
+    client = get_openai_client(job['key_owner'])
+    batch = await client.batches.retrieve(job['id'])
+    if batch.status not in BATCH_FINAL_STATUSES:
+        if batch.status != job['status']:
+            job['status'] = batch.status
+            bot_data.save_batch_job(job)
+        return
     
-    for user_id in users:
+    pending = dict(job['requests'])
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        content = await client.files.content(file_id)
+        for line in content.text.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            request = pending.pop(result.get('custom_id'), None)
+            if request is not None:
+                await deliver_batch_result(request, result)
+    await fail_batch_requests(pending.values(), f"the batch {batch.status}")
+    
+    bot_data.delete_batch_job(job['id'])
+    logger.info(
+        f"Batch {job['id']} {batch.status}: "
+        f"{len(job['requests']) - len(pending)}/{len(job['requests'])} requests answered"
+    )
+
+async def batch_loop():
+    """Submit queued batch prompts and deliver finished jobs
+    
+    With shared state only the worker holding the 'batch' lease does this.
+    """
+    while True:
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        if not await bot_data.acquire_lease('batch', BATCH_LEASE_TTL):
+            continue
+        for job in bot_data.get_batch_jobs():
+            try:
+                await poll_batch_job(job)
+            except Exception as e:
+                logger.warning(f"Polling batch {job['id']} failed: {e}")
+                if time.time() - job['submitted'] > BATCH_ABANDON_AFTER:
+                    await fail_batch_requests(job['requests'].values(), "the batch could not be retrieved")
+                    bot_data.delete_batch_job(job['id'])
         try:
-            await client.send_message(user_id, f"📢 **Broadcast Message**\n\n{broadcast_text}")
-            success += 1
+            await submit_batch_jobs()
         except Exception as e:
-            logger.error(f"Failed to send to {user_id}: {e}")
-            failed += 1
+            logger.error(f"Batch submission failed: {e}")
+
+# Answered inline queries, keyed by (model, normalized query)
+inline_cache = TTLCache(INLINE_CACHE_SIZE, INLINE_CACHE_TTL)
+# Inline answers waiting out the debounce window, per user
+inline_pending: Dict[int, asyncio.Task] = {}
+
+def debounce_inline_query(user_id: int, answer):
+    """Run answer() once the user stops typing
     
-    await status_msg.edit_text(
-        f"✅ Broadcast complete!\n\n"
-        f"Success: {success}\n"
-        f"Failed: {failed}"
-    )
+    Every query replaces the user's pending one; answers already past the
+    debounce window are left to finish.
+    """
+    pending = inline_pending.pop(user_id, None)
+    if pending is not None:
+        pending.cancel()
+    
+    async def wait_then_answer():
+        await asyncio.sleep(INLINE_DEBOUNCE)
+        del inline_pending[user_id]
+        await answer()
+    inline_pending[user_id] = spawn(wait_then_answer())
 
 # Inline query handler
 @app.on_inline_query()
+@instrumented
 async def inline_query_handler(client: Client, inline_query: InlineQuery):
     """Handle inline queries"""
     user_id = inline_query.from_user.id
     
-    if not bot_data.is_user_authorized(user_id):
+    if not bot_data.check_access(user_id):
         await inline_query.answer(
             results=[],
             cache_time=0,
@@ -642,38 +3593,82 @@ async def inline_query_handler(client: Client, inline_query: InlineQuery):
     
     # Get user's model
     model = bot_data.get_user_model(user_id)
+    cache_key = (model, normalize_query(query))
+    deadline = time.monotonic() + INLINE_DEADLINE
     
+    answer = functools.partial(answer_inline_query, inline_query, query, model, cache_key, deadline)
+    if inline_cache.get(cache_key) is None:
+        # Telegram sends an update per keystroke; only the last one is answered
+        debounce_inline_query(user_id, answer)
+        return
+    await answer()
+
+@instrumented
+async def answer_inline_query(inline_query: InlineQuery, query: str, model: str, cache_key: tuple, deadline: float):
+    """Answer an inline query from the cache or with a completion"""
+    user_id = inline_query.from_user.id
     try:
-        # Call OpenAI API
-        messages = [
-            {"role": "system", "content": "You are a helpful AI assistant. Provide clear and concise responses suitable for inline messaging."},
-            {"role": "user", "content": query}
-        ]
+        completion = inline_cache.get(cache_key)
+        if completion is not None:
+            # Nothing is billed again; the footer says so, like /ask does
+            completion = completion._replace(tokens=0, source='cache')
+            bot_data.log_usage(user_id, completion.model, completion.tokens, completion.source)
+        else:
+            # Call OpenAI API
+            messages = [
+                {"role": "system", "content": "You are a helpful AI assistant. Provide clear and concise responses suitable for inline messaging."},
+                {"role": "user", "content": query}
+            ]
+            
+            admission.check_rate(user_id)
+            completion = await call_openai_api(
+                messages, model, user_id, max_tokens=500,
+                priority=PRIORITY_INLINE, deadline=deadline
+            )
+            inline_cache.set(cache_key, completion)
+            
+            # Log usage
+            bot_data.log_usage(user_id, completion.model, completion.tokens, completion.source)
         
-        response, tokens = await call_openai_api(messages, model, user_id, max_tokens=500)
+        response, tokens, used_model = completion.content, completion.tokens, completion.model
+        footer = f"\n\n━━━━━━━━━━━━━━━\n🤖 {used_model} | 🎯 {tokens} tokens"
+        if completion.source == 'cache':
+            footer += " ♻️ cached"
+        elif completion.source == 'coalesced':
+            footer += " 🔗 shared"
         
-        # Log usage
-        bot_data.log_usage(user_id, model, tokens)
+        # An inline result is a single message; cut long answers short
+        parts = split_message(response, TELEGRAM_MESSAGE_LIMIT - len(footer) - 2)
+        message_text = parts[0] + (" …" if len(parts) > 1 else "") + footer
         
         # Create result
         result = InlineQueryResultArticle(
-            title=f"🤖 AI Response ({model})",
+            title=f"🤖 AI Response ({used_model})",
             description=response[:100] + "..." if len(response) > 100 else response,
             input_message_content=InputTextMessageContent(
-                message_text=f"{response}\n\n━━━━━━━━━━━━━━━\n🤖 {model} | 🎯 {tokens} tokens"
+                message_text=message_text
             ),
             reply_markup=InlineKeyboardMarkup([[
                 InlineKeyboardButton("🔄 Ask Another", switch_inline_query_current_chat="")
             ]])
         )
         
+        # Results carry the user's own model, so Telegram must cache them per user
         await inline_query.answer(
             results=[result],
-            cache_time=0
+            cache_time=INLINE_CACHE_TIME,
+            is_personal=True
         )
         
+    except AdmissionRejected as e:
+        await inline_query.answer(
+            results=[],
+            cache_time=0,
+            switch_pm_text=str(e),
+            switch_pm_parameter="help"
+        )
     except Exception as e:
-        logger.error(f"Inline query error: {e}")
+        logger.error(f"Inline query error: {e}", extra={'user_id': user_id, 'model': model})
         error_result = InlineQueryResultArticle(
             title="❌ Error",
             description=str(e),
@@ -685,12 +3680,13 @@ async def inline_query_handler(client: Client, inline_query: InlineQuery):
 
 # Callback query handler
 @app.on_callback_query()
+@instrumented
 async def callback_query_handler(client: Client, callback_query: CallbackQuery):
     """Handle callback queries"""
     data = callback_query.data
     user_id = callback_query.from_user.id
     
-    if not bot_data.is_user_authorized(user_id):
+    if not bot_data.check_access(user_id):
         await callback_query.answer("❌ Unauthorized access.", show_alert=True)
         return
     
@@ -699,7 +3695,7 @@ async def callback_query_handler(client: Client, callback_query: CallbackQuery):
         text = f"**🤖 Select Your AI Model**\n\nCurrent: `{current_model}`"
         await callback_query.message.edit_text(
             text,
-            reply_markup=create_model_keyboard()
+            reply_markup=ui.model_keyboard()
         )
     
     elif data.startswith("model_"):
@@ -709,11 +3705,11 @@ async def callback_query_handler(client: Client, callback_query: CallbackQuery):
         await callback_query.message.edit_text(
             f"✅ **Model Updated!**\n\nYour default model is now: `{model}`\n\n"
             f"{AVAILABLE_MODELS.get(model, model)}",
-            reply_markup=create_main_menu()
+            reply_markup=ui.main_menu
         )
     
     elif data == "stats":
-        stats = bot_data.data['usage_stats'].get(str(user_id))
+        stats = await bot_data.get_usage_stats(user_id)
         
         if not stats:
             await callback_query.answer("No statistics available yet.", show_alert=True)
@@ -729,29 +3725,19 @@ async def callback_query_handler(client: Client, callback_query: CallbackQuery):
         
         await callback_query.message.edit_text(
             text,
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("« Back", callback_data="back_to_menu")
-            ]])
+            reply_markup=ui.back_keyboard
         )
     
     elif data == "help":
-        help_text = "📚 **Quick Help**\n\n"
-        help_text += "• Use /ask to ask questions\n"
-        help_text += "• Use /model to change AI model\n"
-        help_text += "• Use inline mode for quick queries\n"
-        help_text += "• Use /help for detailed instructions"
-        
         await callback_query.message.edit_text(
-            help_text,
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("« Back", callback_data="back_to_menu")
-            ]])
+            ui.quick_help,
+            reply_markup=ui.back_keyboard
         )
     
     elif data == "back_to_menu":
         await callback_query.message.edit_text(
             "🤖 **Main Menu**\n\nSelect an option:",
-            reply_markup=create_main_menu()
+            reply_markup=ui.main_menu
         )
     
     await callback_query.answer()
@@ -760,42 +3746,281 @@ async def callback_query_handler(client: Client, callback_query: CallbackQuery):
 @app.on_message(filters.text & filters.private & ~filters.command([
     "start", "ask", "model", "stats", "help", "auth", "revoke",
     "authgroup", "revokegroup", "ban", "unban", "broadcast",
-    "setapikey", "removeapikey", "myapikey"
+    "setapikey", "removeapikey", "myapikey", "reset", "batch"
 ]))
+@instrumented
 async def natural_conversation_handler(client: Client, message: Message):
     """Handle natural conversation in private chats"""
     user_id = message.from_user.id
     
-    if not bot_data.is_user_authorized(user_id):
+    if not bot_data.check_access(user_id):
         await message.reply_text("❌ You are not authorized to use this bot.")
         return
     
+    # The answer can take minutes; the update worker is not kept waiting
+    spawn(continue_conversation(client, message))
+
+@instrumented
+async def continue_conversation(client: Client, message: Message):
+    """Answer a private chat message in the context of the conversation"""
+    user_id = message.from_user.id
+    
     # Get user's model preference
     model = bot_data.get_user_model(user_id)
     
     # Send typing action
     await client.send_chat_action(message.chat.id, enums.ChatAction.TYPING)
     
+    # Streamed replies are edited into a placeholder message
+    reply_msg = await message.reply_text("💭 ...") if STREAM_RESPONSES else None
+    
     try:
-        # Call OpenAI API
-        messages = [
-            {"role": "system", "content": "You are a friendly and helpful AI assistant. Engage in natural conversation."},
-            {"role": "user", "content": message.text}
-        ]
+        # Call OpenAI API with the recent conversation as context
+        messages = await conversations.build_messages(
+            message.chat.id,
+            "You are a friendly and helpful AI assistant. Engage in natural conversation.",
+            message.text,
+            model
+        )
         
-        response, tokens = await call_openai_api(messages, model, user_id)
+        editor = StreamEditor.for_chat(reply_msg) if reply_msg else None
+        admission.check_rate(user_id)
+        result = await call_openai_api(
+            messages, model, user_id,
+            on_delta=editor.push if editor else None
+        )
+        response = result.content
         
         # Log usage
-        bot_data.log_usage(user_id, model, tokens)
+        bot_data.log_usage(user_id, result.model, result.tokens, result.source)
+        conversations.append(message.chat.id, message.text, response)
         
-        await message.reply_text(response)
+        await deliver_response(message, response, reply_msg)
         
     except Exception as e:
-        logger.error(f"Error in natural conversation: {e}")
-        await message.reply_text(
-            f"❌ Sorry, an error occurred: `{str(e)}`"
+        if isinstance(e, AdmissionRejected):
+            error_text = str(e)
+        else:
+            logger.error(
+                f"Error in natural conversation: {e}",
+                extra={'user_id': user_id, 'chat_id': message.chat.id, 'model': model}
+            )
+            error_text = f"❌ Sorry, an error occurred: `{str(e)}`"
+        if reply_msg:
+            await reply_msg.edit_text(error_text)
+        else:
+            await message.reply_text(error_text)
+
+async def usage_flush_loop():
+    """Periodically persist buffered usage statistics"""
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+        try:
+            bot_data.flush_usage()
+        except Exception as e:
+            logger.error(f"Usage flush failed: {e}")
+
+async def load_tokenizers():
+    """Load the encodings in a thread, retrying until all are available"""
+    while not await asyncio.to_thread(warm_tokenizers):
+        await asyncio.sleep(TOKENIZER_RETRY_INTERVAL)
+
+async def sync_shared_state():
+    """Apply the other workers' changes to the in-memory shared state"""
+    storage = bot_data.storage
+    while True:
+        try:
+            async with storage.async_client.pubsub() as pubsub:
+                await pubsub.subscribe(storage.channel)
+                # Changes published before subscribing (during start-up or
+                # while disconnected) were missed
+                await bot_data.reload()
+                async for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    change = json.loads(message['data'])
+                    if change['worker'] != WORKER_ID:
+                        bot_data.apply_change(change['op'], change['section'], change['key'], change['value'])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Shared state sync failed: {e}")
+            await asyncio.sleep(1)
+
+async def handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Serve a single request on the local metrics endpoint"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # Drain headers; requests carry no body
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        path = parts[1].split('?')[0] if len(parts) > 1 else '/'
+        
+        handler = http_routes.get(path)
+        if handler is None:
+            status, content_type, body = '404 Not Found', 'text/plain', 'not found\n'
+        else:
+            status, content_type, body = handler()
+        payload = body.encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload
         )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
 
-if __name__ == "__main__":
+# Seconds each startup phase took, in order
+startup_phases: Dict[str, float] = {}
+
+@contextmanager
+def startup_phase(name: str):
+    """Time a startup phase"""
+    started = time.monotonic()
+    yield
+    startup_phases[name] = round(time.monotonic() - started, 3)
+    logger.info(f"Startup phase {name} took {startup_phases[name]:.3f}s")
+
+class Health:
+    """Liveness and readiness of the bot
+    
+    The bot is ready once storage is loaded, the Telegram session is
+    connected and the last backend probe succeeded. Probes list the
+    models every HEALTH_PROBE_INTERVAL seconds, so health checks never
+    wait on the backend themselves.
+    """
+    
+    def __init__(self):
+        self.started = time.monotonic()
+        self.backend_ok: Optional[bool] = None
+        self.backend_error: Optional[str] = None
+    
+    async def probe_backend(self):
+        """Check that the OpenAI API answers"""
+        init_openai()
+        try:
+            await asyncio.wait_for(openai_client.models.list(), HEALTH_PROBE_TIMEOUT)
+            self.backend_ok, self.backend_error = True, None
+        except Exception as e:
+            if self.backend_ok is not False:
+                logger.warning(f"OpenAI backend unreachable: {e}")
+            self.backend_ok, self.backend_error = False, str(e) or type(e).__name__
+    
+    async def probe_loop(self):
+        """Probe the backend periodically"""
+        while True:
+            await self.probe_backend()
+            await asyncio.sleep(HEALTH_PROBE_INTERVAL)
+    
+    def checks(self) -> Dict[str, bool]:
+        return {
+            'storage': bot_data is not None,
+            'telegram': bool(app.is_connected),
+            'backend': bool(self.backend_ok),
+        }
+    
+    def liveness(self) -> tuple:
+        body = {'status': 'alive', 'uptime': round(time.monotonic() - self.started, 1)}
+        return '200 OK', 'application/json', json.dumps(body)
+    
+    def readiness(self) -> tuple:
+        checks = self.checks()
+        ready = all(checks.values())
+        body = {
+            'status': 'ready' if ready else 'starting' if not startup_phases.get('ready') else 'degraded',
+            'checks': checks,
+            'startup': startup_phases,
+        }
+        if self.backend_error:
+            body['backend_error'] = self.backend_error
+        return ('200 OK' if ready else '503 Service Unavailable'), 'application/json', json.dumps(body)
+
+health = Health()
+
+# Local HTTP endpoints: path -> callable returning (status, content type, body)
+http_routes = {
+    '/metrics': lambda: ('200 OK', 'text/plain; version=0.0.4', render_metrics()),
+    '/healthz': health.liveness,
+    '/readyz': health.readiness,
+}
+
+def load_state():
+    """Load bot data and everything built on it"""
+    global bot_data, conversations
+    bot_data = SharedBotData() if STORAGE_BACKEND == 'redis' else BotData()
+    conversations = ConversationStore(bot_data if CONVERSATION_PERSIST else None)
+    if isinstance(bot_data, SharedBotData):
+        for handler in (MessageHandler, CallbackQueryHandler, InlineQueryHandler):
+            app.add_handler(handler(claim_update), group=-1)
+
+async def main():
+    """Run the bot until it receives a stop signal"""
+    # Forked before the logging thread exists
+    with startup_phase('workers'):
+        start_process_pool()
+    with startup_phase('logging'):
+        setup_logging()
     logger.info("Starting Advanced AI Assistant Bot...")
-    app.run()
+    
+    # Served during startup too, so health checks see the bot coming up
+    http_server = None
+    if METRICS_PORT:
+        http_server = await asyncio.start_server(handle_http, METRICS_HOST, METRICS_PORT)
+        logger.info(f"Metrics and health checks at http://{METRICS_HOST}:{METRICS_PORT}")
+    
+    with startup_phase('storage'):
+        load_state()
+    with startup_phase('telegram'):
+        await app.start()
+    with startup_phase('warm_up'):
+        await ui.warm_up(app)
+    # Encodings may need downloading; token counts are estimated meanwhile
+    tokenizer_task = asyncio.create_task(load_tokenizers())
+    probe_task = asyncio.create_task(health.probe_loop())
+    
+    flush_task = asyncio.create_task(usage_flush_loop())
+    batch_task = asyncio.create_task(batch_loop())
+    sync_task = None
+    if isinstance(bot_data, SharedBotData):
+        sync_task = asyncio.create_task(sync_shared_state())
+        logger.info(f"Sharing state through {REDIS_URL} as worker {WORKER_ID}")
+    
+    startup_phases['ready'] = round(time.monotonic() - health.started, 3)
+    logger.info(f"Bot started in {startup_phases['ready']:.3f}s")
+    
+    # Resume a broadcast interrupted by a restart
+    broadcast_state = bot_data.get_broadcast()
+    if broadcast_state and await bot_data.acquire_lease('broadcast', BROADCAST_LEASE_TTL):
+        logger.info(f"Resuming broadcast at {broadcast_state['cursor']}/{len(broadcast_state['users'])}")
+        start_broadcast(Broadcast(app, broadcast_state))
+    
+    try:
+        await idle()
+    finally:
+        flush_task.cancel()
+        batch_task.cancel()
+        probe_task.cancel()
+        tokenizer_task.cancel()
+        if sync_task:
+            sync_task.cancel()
+        if http_server:
+            http_server.close()
+        await stop_broadcast()
+        await drain_background_tasks()
+        await app.stop()
+        # Final flush of buffered usage statistics
+        if isinstance(bot_data, SharedBotData):
+            bot_data.flush_usage()
+            await bot_data.storage.drain()
+        bot_data.close()
+        if isinstance(bot_data, SharedBotData):
+            await bot_data.storage.aclose()
+        if openai_http_client:
+            await openai_http_client.aclose()
+        stop_process_pool()
+
+if __name__ == "__main__":
+    app.run(main())